@@ -0,0 +1,66 @@
+"""Достижения
+
+Каждое правило объявляет, от каких счётчиков зависит. При рюмке проверяются
+только правила, чьи счётчики изменились, а открытые достижения хранятся
+битовой маской в users.achievements_mask.
+"""
+
+class Achievement:
+    """Достижение: бит в маске, название и условие по счётчикам"""
+    __slots__ = ('bit', 'key', 'title', 'depends', 'check')
+
+    def __init__(self, bit, key, title, depends, check):
+        self.bit = bit
+        self.key = key
+        self.title = title
+        self.depends = frozenset(depends)
+        self.check = check
+
+    @property
+    def flag(self):
+        return 1 << self.bit
+
+def _reached(bit, key, title, counter, threshold):
+    """Достижение за порог одного счётчика"""
+    return Achievement(bit, key, title, (counter,), lambda counters: counters[counter] >= threshold)
+
+# Биты не менять и не переиспользовать - они уже записаны в базе
+ACHIEVEMENTS = [
+    _reached(0, 'first_drink', '🥃 Первая рюмка', 'total_drinks', 1),
+    _reached(1, 'total_10', '🍺 Десятка', 'total_drinks', 10),
+    _reached(2, 'total_100', '💯 Сотка', 'total_drinks', 100),
+    _reached(3, 'total_500', '🌟 Живая легенда', 'total_drinks', 500),
+    _reached(4, 'today_3', '🔥 Разгон', 'today_drinks', 3),
+    _reached(5, 'today_5', '🌙 Всю ночь', 'today_drinks', 5),
+    _reached(6, 'vodka_100', '💧 Сто литров', 'vodka_liters', 100),
+    _reached(7, 'vodka_1000', '🌊 Водопад', 'vodka_liters', 1000),
+    _reached(8, 'group_10', '👥 Душа компании', 'drinks_in_group', 10),
+    _reached(9, 'group_50', '🍻 Завсегдатай', 'drinks_in_group', 50),
+]
+
+# Правила по счётчикам, от которых они зависят
+_BY_COUNTER = {}
+for _achievement in ACHIEVEMENTS:
+    for _counter in _achievement.depends:
+        _BY_COUNTER.setdefault(_counter, []).append(_achievement)
+
+def evaluate(mask, counters):
+    """Проверить правила, зависящие от counters. Возвращает (новая маска, открытые достижения)"""
+    unlocked = []
+    seen = set()
+
+    for counter in counters:
+        for achievement in _BY_COUNTER.get(counter, ()):
+            if mask & achievement.flag or achievement.bit in seen:
+                continue
+            seen.add(achievement.bit)
+            # Правило может зависеть и от счётчиков, которых сейчас нет
+            if achievement.depends <= counters.keys() and achievement.check(counters):
+                mask |= achievement.flag
+                unlocked.append(achievement)
+
+    return mask, unlocked
+
+def unlocked_achievements(mask):
+    """Открытые достижения по маске"""
+    return [achievement for achievement in ACHIEVEMENTS if mask & achievement.flag]
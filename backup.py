@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import database
+
+logger = logging.getLogger(__name__)
+
+# Настройки бэкапов
+BACKUP_DIR = os.getenv('BACKUP_DIR', 'backups')
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', '7'))  # Сколько снимков хранить
+BACKUP_INTERVAL_HOURS = float(os.getenv('BACKUP_INTERVAL_HOURS', '24'))
+BACKUP_PAGES_PER_STEP = 256  # Страниц за один шаг копирования
+BACKUP_STEP_PAUSE = 0.05  # Пауза между шагами, чтобы не мешать записи
+BACKUP_MAX_RESTARTS = 3  # После стольких перезапусков копировать за один шаг
+
+BACKUP_PREFIX = 'vodka_meter-'
+
+_backup_lock = threading.Lock()
+
+class _BackupRestarted(Exception):
+    """Копирование началось заново из-за записи в исходную БД"""
+
+def _copy_database(target_path, pages):
+    """Скопировать БД в target_path по pages страниц за шаг"""
+    restarts = 0
+    last_remaining = None
+
+    def progress(status, remaining, total):
+        nonlocal restarts, last_remaining
+        # Запись в исходную БД заставляет SQLite начать копирование сначала
+        if last_remaining is not None and remaining > last_remaining:
+            restarts += 1
+            if restarts > BACKUP_MAX_RESTARTS:
+                raise _BackupRestarted()
+        last_remaining = remaining
+        # Отпустить БД между шагами
+        time.sleep(BACKUP_STEP_PAUSE)
+
+    source = sqlite3.connect(database.DB_PATH)
+    target = sqlite3.connect(target_path)
+    try:
+        source.backup(target, pages=pages, progress=progress if pages > 0 else None)
+        # Снимок должен быть самодостаточным файлом без -wal
+        target.execute('PRAGMA journal_mode = DELETE')
+    finally:
+        target.close()
+        source.close()
+
+def _verify_backup(path):
+    """Проверить целостность снимка"""
+    conn = sqlite3.connect(path)
+    try:
+        result = conn.execute('PRAGMA integrity_check').fetchone()
+    finally:
+        conn.close()
+
+    return result is not None and result[0] == 'ok'
+
+def list_backups():
+    """Список снимков от старых к новым"""
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+
+    names = sorted(
+        name for name in os.listdir(BACKUP_DIR)
+        if name.startswith(BACKUP_PREFIX) and name.endswith('.db')
+    )
+    return [os.path.join(BACKUP_DIR, name) for name in names]
+
+def _rotate_backups():
+    """Удалить старые снимки сверх BACKUP_KEEP"""
+    backups = list_backups()
+    for path in backups[:max(0, len(backups) - BACKUP_KEEP)]:
+        os.remove(path)
+
+def make_backup():
+    """Сделать снимок БД без остановки бота
+
+    Возвращает (путь, размер в байтах, секунды).
+    """
+    if not _backup_lock.acquire(blocking=False):
+        raise RuntimeError("Бэкап уже выполняется")
+
+    try:
+        started = time.monotonic()
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+
+        name = BACKUP_PREFIX + datetime.now().strftime('%Y%m%d-%H%M%S') + '.db'
+        path = os.path.join(BACKUP_DIR, name)
+        part_path = path + '.part'
+
+        try:
+            try:
+                _copy_database(part_path, BACKUP_PAGES_PER_STEP)
+            except _BackupRestarted:
+                # БД слишком часто меняется - скопировать одним шагом
+                logger.info("Бэкап перезапускался слишком часто, копирую за один шаг")
+                os.remove(part_path)
+                _copy_database(part_path, -1)
+
+            if not _verify_backup(part_path):
+                raise RuntimeError("Снимок не прошёл проверку целостности")
+
+            os.replace(part_path, path)
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+
+        _rotate_backups()
+
+        size = os.path.getsize(path)
+        seconds = time.monotonic() - started
+        logger.info(f"Бэкап {path} готов: {size} байт за {seconds:.1f}с")
+        return path, size, seconds
+    finally:
+        _backup_lock.release()
+
+async def backup_loop():
+    """Периодический бэкап в фоне"""
+    loop = asyncio.get_running_loop()
+
+    while True:
+        await asyncio.sleep(BACKUP_INTERVAL_HOURS * 3600)
+        try:
+            await loop.run_in_executor(None, make_backup)
+        except (RuntimeError, sqlite3.Error, OSError) as e:
+            logger.error(f"Ошибка бэкапа: {e}")
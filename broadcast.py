@@ -0,0 +1,240 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError, TimedOut
+
+import database
+from throttle import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram: около 30 сообщений в секунду на бота
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))  # Сообщений в секунду
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '10'))
+BROADCAST_PAGE_SIZE = 100  # Получателей за одну выборку и одну контрольную точку
+MAX_ATTEMPTS = 3
+
+AUDIENCES = {
+    'users': 'SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?',
+    'groups': 'SELECT group_id FROM groups WHERE group_id > ? ORDER BY group_id LIMIT ?',
+}
+
+_START_CURSOR = -2 ** 63
+
+_active_task = None
+_active_broadcast = None
+
+class _Broadcast:
+    """Состояние рассылки, как в таблице broadcasts"""
+
+    def __init__(self, row):
+        (self.id, self.audience, self.text, self.status, self.last_id,
+         self.delivered, self.blocked, self.failed, self.admin_chat_id) = row
+        self.pause_until = 0.0
+
+def _connect():
+    return sqlite3.connect(database.DB_PATH)
+
+def _load(broadcast_id=None):
+    """Рассылка по id или последняя незавершённая"""
+    conn = _connect()
+    try:
+        columns = 'id, audience, text, status, last_id, delivered, blocked, failed, admin_chat_id'
+        if broadcast_id is None:
+            row = conn.execute(
+                f"SELECT {columns} FROM broadcasts WHERE status = 'running' ORDER BY id LIMIT 1"
+            ).fetchone()
+        else:
+            row = conn.execute(f'SELECT {columns} FROM broadcasts WHERE id = ?', (broadcast_id,)).fetchone()
+    finally:
+        conn.close()
+    return _Broadcast(row) if row else None
+
+def _create(audience, text, admin_chat_id):
+    """Записать новую рассылку"""
+    with database._db_lock:
+        conn = _connect()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO broadcasts (audience, text, status, last_id, admin_chat_id, created)
+            VALUES (?, ?, 'running', ?, ?, ?)
+        ''', (audience, text, _START_CURSOR, admin_chat_id, datetime.now().isoformat()))
+        conn.commit()
+        broadcast_id = cursor.lastrowid
+        conn.close()
+    return broadcast_id
+
+def _checkpoint(broadcast, status='running'):
+    """Сохранить прогресс: после падения рассылка продолжится отсюда"""
+    with database._db_lock:
+        conn = _connect()
+        conn.execute('''
+            UPDATE broadcasts
+            SET status = ?, last_id = ?, delivered = ?, blocked = ?, failed = ?,
+                finished = CASE WHEN ? = 'running' THEN NULL ELSE ? END
+            WHERE id = ?
+        ''', (status, broadcast.last_id, broadcast.delivered, broadcast.blocked, broadcast.failed,
+              status, datetime.now().isoformat(), broadcast.id))
+        conn.commit()
+        conn.close()
+    broadcast.status = status
+
+def _recipients(audience, after_id):
+    """Следующая страница получателей"""
+    conn = _connect()
+    try:
+        rows = conn.execute(AUDIENCES[audience], (after_id, BROADCAST_PAGE_SIZE)).fetchall()
+    finally:
+        conn.close()
+    return [row[0] for row in rows]
+
+async def _take_token(bucket, broadcast):
+    """Дождаться разрешения на отправку с учётом глобального лимита"""
+    while True:
+        wait = max(bucket.wait_time(), broadcast.pause_until - time.monotonic())
+        if wait <= 0 and bucket.consume():
+            return
+        await asyncio.sleep(max(wait, 0.01))
+
+async def _send_one(bot, broadcast, chat_id, bucket, semaphore):
+    """Отправить одно сообщение: 'delivered', 'blocked' или 'failed'"""
+    async with semaphore:
+        for attempt in range(MAX_ATTEMPTS):
+            await _take_token(bucket, broadcast)
+            try:
+                await bot.send_message(chat_id, broadcast.text)
+                return 'delivered'
+            except RetryAfter as e:
+                # Флуд-контроль касается всего бота - притормозить всех
+                broadcast.pause_until = max(broadcast.pause_until, time.monotonic() + e.retry_after)
+            except Forbidden:
+                return 'blocked'
+            except BadRequest as e:
+                logger.info(f"Рассылка {broadcast.id}: {chat_id} недоступен: {e}")
+                return 'failed'
+            except TimedOut:
+                # Запрос ушёл, ответ не дождались - Telegram часто всё же доставляет.
+                # Повтор дал бы дубль, поэтому считаем доставленным
+                logger.info(f"Рассылка {broadcast.id}: таймаут отправки в {chat_id}, не повторяю")
+                return 'delivered'
+            except NetworkError:
+                # Соединения не было - сообщение точно не ушло, можно повторить
+                await asyncio.sleep(2 ** attempt)
+            except TelegramError as e:
+                logger.info(f"Рассылка {broadcast.id}: не удалось отправить в {chat_id}: {e}")
+                return 'failed'
+        return 'failed'
+
+async def _run(bot, broadcast):
+    """Пройти всех получателей постранично"""
+    bucket = TokenBucket(min(5, BROADCAST_RATE), BROADCAST_RATE)
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    loop = asyncio.get_running_loop()
+
+    while True:
+        recipients = await loop.run_in_executor(None, _recipients, broadcast.audience, broadcast.last_id)
+        if not recipients:
+            break
+
+        results = await asyncio.gather(*(
+            _send_one(bot, broadcast, chat_id, bucket, semaphore) for chat_id in recipients
+        ))
+        for result in results:
+            setattr(broadcast, result, getattr(broadcast, result) + 1)
+
+        broadcast.last_id = recipients[-1]
+        await loop.run_in_executor(None, _checkpoint, broadcast)
+
+    await loop.run_in_executor(None, _checkpoint, broadcast, 'done')
+
+    if broadcast.admin_chat_id:
+        await bot.send_message(broadcast.admin_chat_id, f"📣 Рассылка #{broadcast.id} завершена\n\n{format_status(broadcast)}")
+
+def _start_task(bot, broadcast):
+    global _active_task, _active_broadcast
+
+    async def run():
+        global _active_task, _active_broadcast
+        try:
+            await _run(bot, broadcast)
+        except asyncio.CancelledError:
+            # Остановка бота: статус остаётся running, продолжим при запуске
+            raise
+        except Exception as e:
+            logger.error(f"Рассылка {broadcast.id} прервана: {e}")
+        finally:
+            _active_task = None
+            _active_broadcast = None
+
+    _active_broadcast = broadcast
+    _active_task = asyncio.create_task(run())
+    return _active_task
+
+def is_running():
+    """Идёт ли рассылка"""
+    return _active_task is not None
+
+def start_broadcast(bot, audience, text, admin_chat_id):
+    """Начать рассылку, вернуть её id"""
+    if audience not in AUDIENCES:
+        raise ValueError("Получатели: users или groups")
+    if is_running():
+        raise RuntimeError("Уже идёт другая рассылка")
+
+    broadcast = _load(_create(audience, text, admin_chat_id))
+    _start_task(bot, broadcast)
+    return broadcast.id
+
+def resume_broadcast(bot):
+    """Продолжить прерванную рассылку после перезапуска"""
+    broadcast = _load()
+    if broadcast is None or is_running():
+        return None
+    logger.info(f"Продолжаю рассылку {broadcast.id} с {broadcast.last_id}")
+    return _start_task(bot, broadcast)
+
+async def suspend_broadcast():
+    """Прервать рассылку при остановке бота, оставив её в статусе running"""
+    task = _active_task
+    if task is not None:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+async def stop_broadcast():
+    """Отменить текущую рассылку"""
+    task, broadcast = _active_task, _active_broadcast
+    if task is None:
+        return None
+
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    await asyncio.get_running_loop().run_in_executor(None, _checkpoint, broadcast, 'cancelled')
+    return broadcast
+
+def format_status(broadcast):
+    """Текст о ходе рассылки"""
+    statuses = {'running': 'идёт', 'done': 'завершена', 'cancelled': 'отменена'}
+    return (
+        f"Получатели: {broadcast.audience}, статус: {statuses.get(broadcast.status, broadcast.status)}\n"
+        f"✅ Доставлено: {broadcast.delivered}\n"
+        f"🚫 Заблокировали бота: {broadcast.blocked}\n"
+        f"❌ Ошибки: {broadcast.failed}"
+    )
+
+def last_status():
+    """Состояние текущей или последней рассылки"""
+    broadcast = _active_broadcast
+    if broadcast is None:
+        conn = _connect()
+        try:
+            row = conn.execute('SELECT MAX(id) FROM broadcasts').fetchone()
+        finally:
+            conn.close()
+        if row[0] is None:
+            return "Рассылок ещё не было"
+        broadcast = _load(row[0])
+    return f"📣 Рассылка #{broadcast.id}\n\n{format_status(broadcast)}"
@@ -1,22 +1,60 @@
 import sqlite3
 import os
-from datetime import datetime, timedelta
+import time
+from datetime import date, datetime, timedelta
 from functools import lru_cache
 import threading
 
+from achievements import evaluate
+
 DB_PATH = 'vodka_meter.db'
 
 # Потокобезопасность и кэширование
 _db_lock = threading.Lock()
 _user_cache = {}
+# В пуле воркеров пользователь пишет из разных процессов - кэш строк users там выключен
+USE_USER_CACHE = True
 _group_cache = {}
 
+# Известные группы и участники - чтобы не писать в БД при каждой команде
+_known_groups = {}  # group_id -> group_name
+_known_members = {}  # group_id -> set(user_id)
+
+DRINK_COOLDOWN = 5 * 3600  # Секунд между рюмками
+
+# PRAGMA user_version после переноса дат из текста в числа
+SCHEMA_INTEGER_TIMES = 1
+
+# Время хранится в секундах эпохи, дни - номерами date.toordinal() по местному времени.
+# Те же преобразования на SQL: текст ISO записан datetime.now(), то есть в местном времени
+_SQL_EPOCH = "CAST(strftime('%s', {}, 'utc') AS INTEGER)"
+_SQL_DAY = "CAST(julianday(substr({}, 1, 10)) - 1721424.5 AS INTEGER)"
+
+def today_number():
+    """Номер сегодняшнего дня"""
+    return date.today().toordinal()
+
+def _epoch_from_text(text):
+    """Секунды эпохи из старой ISO-строки"""
+    return int(datetime.fromisoformat(text).timestamp()) if text else None
+
+def _day_from_text(text):
+    """Номер дня из старой строки YYYY-MM-DD"""
+    return date.fromisoformat(text[:10]).toordinal() if text else None
+
+def _add_column_if_missing(cursor, table, column, definition):
+    """Добавить колонку в существующую таблицу"""
+    columns = [row[1] for row in cursor.execute(f'PRAGMA table_info({table})')]
+    if column not in columns:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
 def init_db():
     """Инициализация базы данных с оптимизацией"""
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     
     # Оптимизация для больших объемов данных
+    cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')  # Действует только для новой БД
     cursor.execute('PRAGMA journal_mode = WAL')  # Write-Ahead Logging
     cursor.execute('PRAGMA synchronous = NORMAL')  # Быстрее, но безопасно
     cursor.execute('PRAGMA cache_size = -64000')  # 64MB кэша
@@ -34,14 +72,28 @@ def init_db():
             level INTEGER DEFAULT 1,
             achievements TEXT DEFAULT '',
             vodka_liters REAL DEFAULT 0,
-            last_drink_time TEXT DEFAULT NULL
+            last_drink_time TEXT DEFAULT NULL,
+            achievements_mask INTEGER DEFAULT 0,
+            last_drink_ts INTEGER,
+            last_drink_day INTEGER,
+            join_ts INTEGER
         )
     ''')
     
+    # Миграция старых баз. Текстовые даты (last_drink_date, join_date, last_drink_time)
+    # больше не пишутся: их переносит migrate_times_step, а до того их читает запасной путь
+    # Каждая новая колонка users/groups меняет строки в кэше - с ней поднимается snapshot.SNAPSHOT_VERSION
+    _add_column_if_missing(cursor, 'users', 'achievements_mask', 'INTEGER DEFAULT 0')  # снимок v2
+    _add_column_if_missing(cursor, 'users', 'last_drink_ts', 'INTEGER')  # снимок v3
+    _add_column_if_missing(cursor, 'users', 'last_drink_day', 'INTEGER')  # снимок v3
+    _add_column_if_missing(cursor, 'users', 'join_ts', 'INTEGER')  # снимок v3
+    
     # Индексы для быстрого поиска
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_level ON users(level)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_total_drinks ON users(total_drinks DESC)')
+    cursor.execute('DROP INDEX IF EXISTS idx_users_today')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_day ON users(last_drink_day, today_drinks DESC)')
     
     # Таблица рекордов
     cursor.execute('''
@@ -64,11 +116,20 @@ def init_db():
             group_id INTEGER PRIMARY KEY,
             group_name TEXT,
             total_drinks INTEGER DEFAULT 0,
-            join_date TEXT
+            join_date TEXT,
+            join_ts INTEGER,
+            live_message_id INTEGER
         )
     ''')
+    _add_column_if_missing(cursor, 'groups', 'join_ts', 'INTEGER')  # снимок v3
+    _add_column_if_missing(cursor, 'groups', 'live_message_id', 'INTEGER')
     
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_groups_total ON groups(total_drinks DESC)')
+    # Живой топ включён в немногих группах - частичный индекс только по ним
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_groups_live ON groups(live_message_id)
+        WHERE live_message_id IS NOT NULL
+    ''')
     
     # Таблица группо́вых статистик
     cursor.execute('''
@@ -87,6 +148,23 @@ def init_db():
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_group_members_user ON group_members(user_id)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_group_members_drinks ON group_members(group_id, drinks_in_group DESC)')
     
+    # Таблица рассылок - прогресс сохраняется, чтобы продолжить после перезапуска
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            audience TEXT,
+            text TEXT,
+            status TEXT,
+            last_id INTEGER,
+            delivered INTEGER DEFAULT 0,
+            blocked INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            admin_chat_id INTEGER,
+            created TEXT,
+            finished TEXT
+        )
+    ''')
+    
     conn.commit()
     conn.close()
 
@@ -94,7 +172,7 @@ def get_or_create_user(user_id, username):
     """Получить или создать пользователя с кэшированием"""
     with _db_lock:
         # Проверить кэш
-        if user_id in _user_cache:
+        if USE_USER_CACHE and user_id in _user_cache:
             return _user_cache[user_id]
         
         conn = sqlite3.connect(DB_PATH)
@@ -105,16 +183,17 @@ def get_or_create_user(user_id, username):
         
         if not user:
             cursor.execute('''
-                INSERT INTO users (user_id, username, join_date)
+                INSERT INTO users (user_id, username, join_ts)
                 VALUES (?, ?, ?)
-            ''', (user_id, username, datetime.now().isoformat()))
+            ''', (user_id, username, int(time.time())))
             conn.commit()
         
         cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
         user = cursor.fetchone()
         
         # Кэшировать
-        _user_cache[user_id] = user
+        if USE_USER_CACHE:
+            _user_cache[user_id] = user
         
         conn.close()
         return user
@@ -123,7 +202,7 @@ def get_user_data(user_id):
     """Получить данные пользователя с кэшированием"""
     with _db_lock:
         # Проверить кэш
-        if user_id in _user_cache:
+        if USE_USER_CACHE and user_id in _user_cache:
             return _user_cache[user_id]
         
         conn = sqlite3.connect(DB_PATH)
@@ -132,7 +211,7 @@ def get_user_data(user_id):
         cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
         user = cursor.fetchone()
         
-        if user:
+        if user and USE_USER_CACHE:
             _user_cache[user_id] = user
         
         conn.close()
@@ -148,57 +227,95 @@ def can_drink(user_id):
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     
-    cursor.execute('SELECT last_drink_time FROM users WHERE user_id = ?', (user_id,))
+    cursor.execute('SELECT last_drink_ts, last_drink_time FROM users WHERE user_id = ?', (user_id,))
     result = cursor.fetchone()
     conn.close()
     
-    if not result or result[0] is None:
+    if not result:
         return True, 0
     
-    last_time = datetime.fromisoformat(result[0])
-    now = datetime.now()
-    diff = now - last_time
+    # Строка ещё не перенесена миграцией - время в тексте
+    last_ts = result[0] if result[0] is not None else _epoch_from_text(result[1])
+    if last_ts is None:
+        return True, 0
     
-    if diff.total_seconds() >= 5 * 3600:  # 5 часов
+    elapsed = int(time.time()) - last_ts
+    if elapsed >= DRINK_COOLDOWN:
         return True, 0
     else:
-        minutes_left = int((5 * 3600 - diff.total_seconds()) / 60)
+        minutes_left = (DRINK_COOLDOWN - elapsed) // 60
         return False, minutes_left
 
 def add_drink(user_id):
-    """Добавить рюмку с случайной водкой (0-10 литров)"""
+    """Добавить рюмку с случайной водкой (0-10 литров)
+
+    Возвращает (литры водки, новые достижения, маска достижений) или None, если 5 часов ещё не прошло.
+    """
     import random
     
     with _db_lock:
         conn = sqlite3.connect(DB_PATH)
         cursor = conn.cursor()
         
-        today = datetime.now().strftime('%Y-%m-%d')
-        now = datetime.now().isoformat()
+        today = today_number()
+        now = int(time.time())
+        
+        # Чтение и запись одной транзакцией: в пуле воркеров пишут и другие процессы
+        cursor.execute('BEGIN IMMEDIATE')
         
         # Получить текущие данные
-        cursor.execute('SELECT total_drinks, today_drinks, last_drink_date, vodka_liters FROM users WHERE user_id = ?', (user_id,))
+        cursor.execute('''
+            SELECT total_drinks, today_drinks, last_drink_day, last_drink_date, vodka_liters, achievements_mask,
+                   join_ts, join_date, last_drink_ts, last_drink_time
+            FROM users WHERE user_id = ?
+        ''', (user_id,))
         result = cursor.fetchone()
+        vodka_gain, unlocked, mask = 0, [], 0
         
         if result:
-            total, today_drinks, last_date, vodka = result
+            total, today_drinks, last_day, last_date, vodka, mask, join_ts, join_date, last_ts, last_time = result
+            
+            # can_drink проверяет до транзакции: другой воркер мог успеть записать рюмку
+            if last_ts is None:
+                last_ts = _epoch_from_text(last_time)
+            if last_ts is not None and now - last_ts < DRINK_COOLDOWN:
+                conn.rollback()
+                conn.close()
+                return None
+            
+            if last_day is None:
+                last_day = _day_from_text(last_date)
+            if join_ts is None:
+                join_ts = _epoch_from_text(join_date)
             
             # Сбросить счетчик если прошли сутки
-            if last_date and last_date != today:
+            if last_day is not None and last_day != today:
                 today_drinks = 0
             
             # Случайная водка от 0 до 10 литров
             vodka_gain = random.randint(0, 10)
             
+            # Достижения считаются по тем же данным и пишутся тем же UPDATE
+            mask, unlocked = evaluate(mask or 0, {
+                'total_drinks': total + 1,
+                'today_drinks': today_drinks + 1,
+                'vodka_liters': vodka + vodka_gain,
+            })
+            
             cursor.execute('''
                 UPDATE users 
                 SET total_drinks = total_drinks + 1,
                     today_drinks = ?,
-                    last_drink_date = ?,
+                    last_drink_day = ?,
                     vodka_liters = ?,
-                    last_drink_time = ?
+                    last_drink_ts = ?,
+                    achievements_mask = ?,
+                    join_ts = ?,
+                    last_drink_date = NULL,
+                    last_drink_time = NULL,
+                    join_date = NULL
                 WHERE user_id = ?
-            ''', (today_drinks + 1, today, vodka + vodka_gain, now, user_id))
+            ''', (today_drinks + 1, today, vodka + vodka_gain, now, mask, join_ts, user_id))
             
             conn.commit()
         
@@ -207,7 +324,71 @@ def add_drink(user_id):
         # Инвалидировать кэш
         _invalidate_user_cache(user_id)
         
-        return vodka_gain if result else 0
+        return vodka_gain, unlocked, mask
+
+# ===== МИГРАЦИЯ ДАТ =====
+
+# Таблица -> (ключ, SET переноса текста в числа, условие "ещё не перенесена")
+_TIME_MIGRATIONS = {
+    'users': ('user_id', f'''
+        last_drink_ts = COALESCE(last_drink_ts, {_SQL_EPOCH.format('last_drink_time')}),
+        last_drink_day = COALESCE(last_drink_day, {_SQL_DAY.format('last_drink_date')}),
+        join_ts = COALESCE(join_ts, {_SQL_EPOCH.format('join_date')}),
+        last_drink_time = NULL, last_drink_date = NULL, join_date = NULL
+    ''', 'last_drink_time IS NOT NULL OR last_drink_date IS NOT NULL OR join_date IS NOT NULL'),
+    'groups': ('group_id', f'''
+        join_ts = COALESCE(join_ts, {_SQL_EPOCH.format('join_date')}),
+        join_date = NULL
+    ''', 'join_date IS NOT NULL'),
+}
+
+def times_migrated():
+    """Все текстовые даты уже перенесены?"""
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        return conn.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_INTEGER_TIMES
+    finally:
+        conn.close()
+
+def migrate_times_step(table, after_id, batch_size):
+    """Перенести даты одной пачки строк с ключом больше after_id.
+
+    Возвращает ключ последней строки пачки или None, если таблица пройдена.
+    Пачки короткие, чтобы запись рюмок не ждала блокировку.
+    """
+    key, assignments, pending = _TIME_MIGRATIONS[table]
+    
+    with _db_lock:
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
+        
+        cursor.execute(f'SELECT {key} FROM {table} WHERE {key} > ? ORDER BY {key} LIMIT ?', (after_id, batch_size))
+        keys = cursor.fetchall()
+        if not keys:
+            conn.close()
+            return None
+        last_id = keys[-1][0]
+        
+        cursor.execute(
+            f'UPDATE {table} SET {assignments} WHERE {key} > ? AND {key} <= ? AND ({pending})',
+            (after_id, last_id)
+        )
+        conn.commit()
+        conn.close()
+        
+        # В кэше могли остаться строки со старыми датами
+        # (только строки этой пачки - обход всего кэша держал бы блокировку)
+        if table == 'users':
+            for user_id, in keys:
+                _user_cache.pop(user_id, None)
+        return last_id
+
+def mark_times_migrated():
+    """Отметить, что миграция дат завершена"""
+    with _db_lock:
+        conn = sqlite3.connect(DB_PATH)
+        conn.execute(f'PRAGMA user_version = {SCHEMA_INTEGER_TIMES}')
+        conn.close()
 
 def get_leaderboard(limit=10):
     """Получить топ пьяниц - оптимизировано"""
@@ -232,12 +413,14 @@ def get_today_leaderboard(limit=10):
         conn = sqlite3.connect(DB_PATH)
         cursor = conn.cursor()
         
+        # today_drinks сбрасывается только при следующей рюмке - вчерашние не считаем
         cursor.execute('''
             SELECT user_id, username, today_drinks 
             FROM users 
+            WHERE last_drink_day = ?
             ORDER BY today_drinks DESC 
             LIMIT ?
-        ''', (limit,))
+        ''', (today_number(), limit))
         
         results = cursor.fetchall()
         conn.close()
@@ -296,6 +479,7 @@ def remove_vodka(user_id, amount):
         conn = sqlite3.connect(DB_PATH)
         cursor = conn.cursor()
         
+        cursor.execute('BEGIN IMMEDIATE')
         cursor.execute('SELECT vodka_liters FROM users WHERE user_id = ?', (user_id,))
         result = cursor.fetchone()
         
@@ -335,32 +519,99 @@ def get_user_by_username(username):
 
 # ===== ГРУППО́ВЫЕ ФУНКЦИИ =====
 
-def add_group(group_id, group_name):
-    """Добавить группу в БД"""
+def load_registry():
+    """Загрузить известные группы и участников в память"""
     with _db_lock:
         conn = sqlite3.connect(DB_PATH)
         cursor = conn.cursor()
         
-        cursor.execute('SELECT group_id FROM groups WHERE group_id = ?', (group_id,))
-        if cursor.fetchone():
-            conn.close()
-            return False
+        groups = dict(cursor.execute('SELECT group_id, group_name FROM groups'))
+        members = {}
+        for group_id, user_id in cursor.execute('SELECT group_id, user_id FROM group_members'):
+            members.setdefault(group_id, set()).add(user_id)
         
-        cursor.execute('''
-            INSERT INTO groups (group_id, group_name, join_date)
-            VALUES (?, ?, ?)
-        ''', (group_id, group_name, datetime.now().isoformat()))
+        conn.close()
         
+        _known_groups.clear()
+        _known_groups.update(groups)
+        _known_members.clear()
+        _known_members.update(members)
+
+def export_hot_state():
+    """Горячее состояние в памяти - для снимка при остановке"""
+    with _db_lock:
+        return {
+            'users': dict(_user_cache),
+            'groups': dict(_group_cache),
+            'known_groups': dict(_known_groups),
+            'known_members': {group_id: set(members) for group_id, members in _known_members.items()},
+        }
+
+def import_hot_state(state):
+    """Восстановить горячее состояние из снимка"""
+    with _db_lock:
+        _user_cache.update(state['users'])
+        _group_cache.update(state['groups'])
+        _known_groups.update(state['known_groups'])
+        _known_members.update(state['known_members'])
+
+def _rename_group(group_id, group_name):
+    """Обновить название группы"""
+    with _db_lock:
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
+        
+        cursor.execute('UPDATE groups SET group_name = ? WHERE group_id = ?', (group_name, group_id))
         conn.commit()
         conn.close()
         
-        # Кэшировать группу
-        _group_cache[group_id] = (group_name, 0)
+        _known_groups[group_id] = group_name
+        if group_id in _group_cache:
+            del _group_cache[group_id]
+
+def add_group(group_id, group_name):
+    """Добавить группу в БД"""
+    # Группа уже известна - писать нужно, только если сменилось название
+    if group_id in _known_groups:
+        if _known_groups[group_id] != group_name:
+            _rename_group(group_id, group_name)
+        return False
+    
+    with _db_lock:
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
         
-        return True
+        cursor.execute('SELECT group_name FROM groups WHERE group_id = ?', (group_id,))
+        existing = cursor.fetchone()
+        if existing:
+            conn.close()
+            _known_groups[group_id] = existing[0]
+        else:
+            cursor.execute('''
+                INSERT INTO groups (group_id, group_name, join_ts)
+                VALUES (?, ?, ?)
+            ''', (group_id, group_name, int(time.time())))
+            
+            conn.commit()
+            conn.close()
+            
+            _known_groups[group_id] = group_name
+            
+            # Кэшировать группу
+            _group_cache[group_id] = (group_name, 0)
+            
+            return True
+    
+    if existing[0] != group_name:
+        _rename_group(group_id, group_name)
+    return False
 
 def add_user_to_group(group_id, user_id):
     """Добавить пользователя в группу"""
+    # Частый случай: пользователь уже в группе
+    if user_id in _known_members.get(group_id, ()):
+        return
+    
     with _db_lock:
         conn = sqlite3.connect(DB_PATH)
         cursor = conn.cursor()
@@ -373,11 +624,16 @@ def add_user_to_group(group_id, user_id):
             conn.commit()
         except:
             pass
+        else:
+            _known_members.setdefault(group_id, set()).add(user_id)
         
         conn.close()
 
-def add_group_drink(group_id, user_id):
-    """Добавить выпивку в группе"""
+def add_group_drink(group_id, user_id, mask=0):
+    """Добавить выпивку в группе, вернуть новые достижения
+
+    mask - маска достижений после рюмки (её вернул add_drink).
+    """
     with _db_lock:
         conn = sqlite3.connect(DB_PATH)
         cursor = conn.cursor()
@@ -389,12 +645,22 @@ def add_group_drink(group_id, user_id):
             WHERE group_id = ?
         ''', (group_id,))
         
-        # Увеличить счетчик пользователя в группе
+        # Увеличить счетчик пользователя в группе и сразу получить новое значение
         cursor.execute('''
             UPDATE group_members 
             SET drinks_in_group = drinks_in_group + 1 
             WHERE group_id = ? AND user_id = ?
+            RETURNING drinks_in_group
         ''', (group_id, user_id))
+        result = cursor.fetchone()
+        unlocked = []
+        
+        # В users пишем только при новом достижении; OR не затирает биты, записанные с тех пор
+        if result:
+            mask, unlocked = evaluate(mask, {'drinks_in_group': result[0]})
+            if unlocked:
+                cursor.execute('UPDATE users SET achievements_mask = achievements_mask | ? WHERE user_id = ?',
+                               (mask, user_id))
         
         conn.commit()
         conn.close()
@@ -402,6 +668,10 @@ def add_group_drink(group_id, user_id):
         # Инвалидировать кэш группы
         if group_id in _group_cache:
             del _group_cache[group_id]
+        if unlocked:
+            _invalidate_user_cache(user_id)
+        
+        return unlocked
 
 def get_group_top(group_id, limit=10):
     """Получить топ в группе - оптимизировано"""
@@ -440,3 +710,24 @@ def get_group_info(group_id):
             _group_cache[group_id] = result
         
         return result
+
+def set_live_message(group_id, message_id):
+    """Запомнить закреплённое сообщение живого топа группы (None - выключить)"""
+    with _db_lock:
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
+        
+        cursor.execute('UPDATE groups SET live_message_id = ? WHERE group_id = ?', (message_id, group_id))
+        conn.commit()
+        conn.close()
+
+def get_live_messages():
+    """Группы с живым топом: group_id -> message_id"""
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    
+    cursor.execute('SELECT group_id, live_message_id FROM groups WHERE live_message_id IS NOT NULL')
+    result = dict(cursor.fetchall())
+    conn.close()
+    
+    return result
@@ -0,0 +1,212 @@
+"""Выгрузка и загрузка данных ВодкаМера
+
+Примеры:
+    python datatool.py export users users.csv
+    python datatool.py export group_members members.jsonl
+    python datatool.py import users users.csv --replace
+
+Данные читаются и пишутся потоком, поэтому память не зависит от размера таблиц.
+Загрузку лучше делать при остановленном боте: его кэши не знают о новых строках.
+"""
+import argparse
+import csv
+import json
+import sqlite3
+import sys
+import time
+
+import database
+from maintenance import MIGRATION_BATCH
+
+TABLES = ('users', 'groups', 'group_members')
+
+FETCH_SIZE = 5000  # Строк за один fetchmany
+INSERT_BATCH = 10000  # Строк за один executemany
+COMMIT_EVERY = 500000  # Строк в одной транзакции
+
+# NULL в CSV: пустая строка - это пустая строка, а не NULL
+CSV_NULL = '\\N'
+
+def _detect_format(path, fmt):
+    """Определить формат файла по расширению"""
+    if fmt:
+        return fmt
+    if path.endswith('.jsonl') or path.endswith('.ndjson'):
+        return 'jsonl'
+    return 'csv'
+
+def _table_columns(conn, table):
+    """Колонки таблицы: имя -> объявленный тип"""
+    return {row[1]: row[2].upper() for row in conn.execute(f'PRAGMA table_info({table})')}
+
+def iter_rows(conn, table):
+    """Потоково отдать строки таблицы: сначала имена колонок, потом строки"""
+    cursor = conn.execute(f'SELECT * FROM {table} ORDER BY rowid')
+    yield [col[0] for col in cursor.description]
+
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        yield from rows
+
+def export_table(table, path, fmt=None):
+    """Выгрузить таблицу в CSV или JSONL, возвращает число строк"""
+    fmt = _detect_format(path, fmt)
+    conn = sqlite3.connect(database.DB_PATH)
+    count = 0
+
+    try:
+        rows = iter_rows(conn, table)
+        columns = next(rows)
+
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            if fmt == 'csv':
+                writer = csv.writer(f)
+                writer.writerow(columns)
+                for row in rows:
+                    writer.writerow([CSV_NULL if value is None else value for value in row])
+                    count += 1
+            else:
+                for row in rows:
+                    f.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False))
+                    f.write('\n')
+                    count += 1
+    finally:
+        conn.close()
+
+    return count
+
+def _read_csv(f, column_types):
+    """Строки CSV как словари. NULL - это CSV_NULL; пустое значение NULL только
+    в нетекстовых колонках (так NULL записывали старые выгрузки), в TEXT это ''"""
+    for row in csv.DictReader(f):
+        yield {
+            key: None if value == CSV_NULL or (value == '' and column_types.get(key) != 'TEXT') else value
+            for key, value in row.items()
+        }
+
+def _read_jsonl(f):
+    """Строки JSONL как словари"""
+    for line in f:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+def _batches(records, columns, size):
+    """Разбить поток словарей на пачки кортежей"""
+    batch = []
+    for record in records:
+        batch.append(tuple(record.get(col) for col in columns))
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _migrate_times(table):
+    """Перенести текстовые даты загруженных строк в числа.
+
+    Старая выгрузка приносит last_drink_date / last_drink_time текстом, а фоновый
+    перенос бота после первого прохода (PRAGMA user_version) их больше не ищет.
+    """
+    after_id = -2 ** 63
+    while after_id is not None:
+        after_id = database.migrate_times_step(table, after_id, MIGRATION_BATCH)
+
+def import_table(table, path, fmt=None, replace=False):
+    """Загрузить таблицу из CSV или JSONL, возвращает число строк"""
+    fmt = _detect_format(path, fmt)
+    database.init_db()
+
+    conn = sqlite3.connect(database.DB_PATH, isolation_level=None)
+    # Массовая загрузка: без fsync на каждый коммит и с большим кэшем
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('PRAGMA cache_size = -256000')
+    count = 0
+
+    try:
+        table_columns = _table_columns(conn, table)
+
+        with open(path, encoding='utf-8', newline='') as f:
+            records = _read_csv(f, table_columns) if fmt == 'csv' else _read_jsonl(f)
+
+            # Колонки берём из первой строки файла
+            first = next(records, None)
+            if first is None:
+                return 0
+
+            columns = [col for col in first if col in table_columns]
+            unknown = [col for col in first if col not in table_columns]
+            if unknown:
+                raise ValueError(f"Неизвестные колонки для {table}: {', '.join(unknown)}")
+
+            verb = 'INSERT OR REPLACE' if replace else 'INSERT OR IGNORE'
+            sql = (
+                f'{verb} INTO {table} ({", ".join(columns)}) '
+                f'VALUES ({", ".join("?" for _ in columns)})'
+            )
+
+            def all_records():
+                yield first
+                yield from records
+
+            conn.execute('BEGIN')
+            in_transaction = 0
+            for batch in _batches(all_records(), columns, INSERT_BATCH):
+                conn.executemany(sql, batch)
+                count += len(batch)
+                in_transaction += len(batch)
+                if in_transaction >= COMMIT_EVERY:
+                    conn.execute('COMMIT')
+                    conn.execute('BEGIN')
+                    in_transaction = 0
+            conn.execute('COMMIT')
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+    if count and table in ('users', 'groups'):
+        _migrate_times(table)
+    return count
+
+def main(argv=None):
+    """Точка входа CLI"""
+    parser = argparse.ArgumentParser(description="Выгрузка и загрузка данных ВодкаМера")
+    parser.add_argument('--db', default=database.DB_PATH, help="путь к базе (по умолчанию %(default)s)")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = sub.add_parser('export', help="выгрузить таблицу")
+    export_parser.add_argument('table', choices=TABLES)
+    export_parser.add_argument('path')
+    export_parser.add_argument('--format', choices=('csv', 'jsonl'))
+
+    import_parser = sub.add_parser('import', help="загрузить таблицу")
+    import_parser.add_argument('table', choices=TABLES)
+    import_parser.add_argument('path')
+    import_parser.add_argument('--format', choices=('csv', 'jsonl'))
+    import_parser.add_argument('--replace', action='store_true', help="перезаписывать существующие строки")
+
+    args = parser.parse_args(argv)
+    database.DB_PATH = args.db
+
+    started = time.monotonic()
+    if args.command == 'export':
+        count = export_table(args.table, args.path, args.format)
+        action = "Выгружено"
+    else:
+        try:
+            count = import_table(args.table, args.path, args.format, args.replace)
+        except ValueError as e:
+            print(f"❌ {e}", file=sys.stderr)
+            return 1
+        action = "Загружено"
+
+    print(f"✅ {action} {count} строк ({args.table}) за {time.monotonic() - started:.1f}с")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,149 @@
+"""Шина событий внутри процесса
+
+Основная запись (рюмка) публикует событие один раз после коммита, а побочные
+действия - уровень, счётчик группы, уведомления - выполняют подписчики в фоне.
+У каждого подписчика своя ограниченная очередь: если он не успевает, publish
+ждёт места и тем самым притормаживает источник событий.
+
+Доставка не больше одного раза: очереди только в памяти. События, которые не
+успели обработать до падения процесса, пропадают - счётчики группы
+(groups.total_drinks, group_members.drinks_in_group) недосчитаются этих рюмок,
+и ничто их потом не сверяет. Уровень пересчитается со следующей рюмкой.
+"""
+import asyncio
+import contextvars
+import logging
+import os
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+EVENT_QUEUE_SIZE = int(os.getenv('EVENT_QUEUE_SIZE', '1000'))  # Событий в очереди подписчика
+EVENT_DRAIN_TIMEOUT = float(os.getenv('EVENT_DRAIN_TIMEOUT', '10'))  # Секунд на дообработку при остановке
+
+@dataclass(frozen=True)
+class DrinkRecorded:
+    """Рюмка записана в users"""
+    user_id: int
+    total_drinks: int
+    vodka_gain: int
+    group_id: Optional[int] = None  # None - рюмка в личке
+    achievements_mask: int = 0  # Маска достижений после рюмки
+    recorded_at: datetime = field(default_factory=datetime.now)
+
+class _Subscriber:
+    """Обработчик события со своей очередью и воркерами"""
+
+    def __init__(self, name, handler, queue_size, workers):
+        self.name = name
+        self.handler = handler
+        self.queue = asyncio.Queue(queue_size)
+        self.workers = workers
+        self.tasks = []
+
+    async def _call(self, event, context):
+        # Обработчик выполняется в контексте publish: так профилировщик относит
+        # его работу к апдейту, который записал рюмку. Копия - один контекст
+        # нельзя войти дважды, а событие получают несколько подписчиков
+        context = context.copy()
+        if asyncio.iscoroutinefunction(self.handler):
+            await context.run(asyncio.ensure_future, self.handler(event))
+        else:
+            # Синхронные обработчики ходят в БД - не блокировать цикл событий
+            await asyncio.get_running_loop().run_in_executor(None, context.run, self.handler, event)
+
+    async def run(self, stats):
+        while True:
+            event, context = await self.queue.get()
+            try:
+                await self._call(event, context)
+                stats['handled', self.name] += 1
+            except Exception:
+                stats['failed', self.name] += 1
+                logger.exception(f"Подписчик {self.name} упал на {type(event).__name__}")
+            finally:
+                self.queue.task_done()
+
+class EventBus:
+    """Типизированная шина: подписка по классу события"""
+
+    def __init__(self):
+        self._subscribers = {}  # класс события -> [_Subscriber]
+        self._stats = Counter()
+        self.running = False
+
+    def subscribe(self, event_type, handler, name=None, queue_size=EVENT_QUEUE_SIZE, workers=1):
+        """Подписать обработчик (обычный или async) на события класса event_type"""
+        subscriber = _Subscriber(name or handler.__name__, handler, queue_size, workers)
+        self._subscribers.setdefault(event_type, []).append(subscriber)
+        if self.running:
+            self._start_subscriber(subscriber)
+        return subscriber
+
+    def _start_subscriber(self, subscriber):
+        for _ in range(subscriber.workers):
+            subscriber.tasks.append(asyncio.create_task(subscriber.run(self._stats)))
+
+    def _all(self):
+        return [subscriber for subscribers in self._subscribers.values() for subscriber in subscribers]
+
+    def start(self):
+        """Запустить воркеры подписчиков"""
+        self.running = True
+        for subscriber in self._all():
+            self._start_subscriber(subscriber)
+
+    async def publish(self, event):
+        """Отдать событие подписчикам; при полной очереди ждать места"""
+        self._stats['published', type(event).__name__] += 1
+        item = (event, contextvars.copy_context())
+        for subscriber in self._subscribers.get(type(event), ()):
+            try:
+                subscriber.queue.put_nowait(item)
+            except asyncio.QueueFull:
+                self._stats['backpressure', subscriber.name] += 1
+                await subscriber.queue.put(item)
+
+    async def stop(self, timeout=EVENT_DRAIN_TIMEOUT):
+        """Дообработать очереди и остановить воркеры"""
+        subscribers = self._all()
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(subscriber.queue.join() for subscriber in subscribers)), timeout
+            )
+        except asyncio.TimeoutError:
+            lost = sum(subscriber.queue.qsize() for subscriber in subscribers)
+            logger.warning(f"Шина событий остановлена, не обработано событий: {lost}")
+
+        tasks = [task for subscriber in subscribers for task in subscriber.tasks]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        for subscriber in subscribers:
+            subscriber.tasks.clear()
+        self.running = False
+
+    def clear(self):
+        """Снять всех подписчиков (шина должна быть остановлена)"""
+        self._subscribers.clear()
+
+    def queue_depth(self):
+        """Событий в очередях всех подписчиков"""
+        return sum(subscriber.queue.qsize() for subscriber in self._all())
+
+    def stats(self):
+        """Счётчики по подписчикам"""
+        lines = [f"В очередях: {self.queue_depth()}"]
+        for subscriber in self._all():
+            lines.append(
+                f"{subscriber.name}: обработано {self._stats['handled', subscriber.name]}, "
+                f"ошибок {self._stats['failed', subscriber.name]}, "
+                f"ожиданий места {self._stats['backpressure', subscriber.name]}"
+            )
+        return "\n".join(lines)
+
+bus = EventBus()
@@ -0,0 +1,118 @@
+"""Живой топ группы
+
+Вместо нового сообщения на каждый /grouptop бот держит в группе одно
+закреплённое сообщение и правит его сам. Рюмка в группе только помечает её
+«грязной», а фоновый цикл раз в LIVETOP_INTERVAL секунд перерисовывает
+грязные группы - одна правка на группу, сколько бы рюмок ни было выпито.
+"""
+import asyncio
+import logging
+import os
+
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+import database
+from throttle import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+LIVETOP_INTERVAL = float(os.getenv('LIVETOP_INTERVAL', '5'))  # Секунд между обновлениями
+LIVETOP_RATE = float(os.getenv('LIVETOP_RATE', '20'))  # Правок в секунду на все группы
+
+# Ошибки правки, после которых сообщения живого топа больше нет
+_GONE_ERRORS = ("message to edit not found", "message can't be edited")
+
+_live = {}  # group_id -> id закреплённого сообщения
+_dirty = set()  # Группы, где счётчики менялись с прошлого обновления
+_rendered = {}  # group_id -> текст в сообщении сейчас
+
+def load():
+    """Загрузить группы с живым топом при старте"""
+    _live.clear()
+    _live.update(database.get_live_messages())
+
+def live_message(group_id):
+    """id закреплённого сообщения или None"""
+    return _live.get(group_id)
+
+def enable(group_id, message_id, text):
+    """Включить живой топ на уже отправленном сообщении"""
+    database.set_live_message(group_id, message_id)
+    _live[group_id] = message_id
+    _rendered[group_id] = text
+    _dirty.discard(group_id)
+
+def disable(group_id):
+    """Выключить живой топ, вернуть id его сообщения"""
+    database.set_live_message(group_id, None)
+    _rendered.pop(group_id, None)
+    _dirty.discard(group_id)
+    return _live.pop(group_id, None)
+
+def mark_dirty(group_id):
+    """Счётчики группы изменились"""
+    if group_id in _live:
+        _dirty.add(group_id)
+
+async def _refresh(bot, render, group_id, bucket):
+    """Перерисовать одну группу; False - надо повторить позже"""
+    message_id = _live.get(group_id)
+    if message_id is None:
+        return True
+
+    loop = asyncio.get_running_loop()
+    text = await loop.run_in_executor(None, render, group_id)
+    if text == _rendered.get(group_id):
+        return True
+
+    while not bucket.consume():
+        await asyncio.sleep(bucket.wait_time())
+
+    try:
+        await bot.edit_message_text(text, chat_id=group_id, message_id=message_id, parse_mode='Markdown')
+    except RetryAfter as e:
+        await asyncio.sleep(e.retry_after)
+        return False
+    except BadRequest as e:
+        error = str(e).lower()
+        if 'not modified' in error:
+            _rendered[group_id] = text
+            return True
+        if any(reason in error for reason in _GONE_ERRORS):
+            # Сообщение удалили - выключить, пока не попросят снова
+            logger.info(f"Живой топ группы {group_id} выключен: {e}")
+            await loop.run_in_executor(None, disable, group_id)
+            return True
+        # Остальное (например, ошибка разметки) не повод выключать - повторим позже
+        logger.warning(f"Не удалось обновить живой топ группы {group_id}: {e}")
+        return False
+    except Forbidden:
+        # Бота убрали из группы
+        await loop.run_in_executor(None, disable, group_id)
+        return True
+    except TelegramError as e:
+        logger.warning(f"Не удалось обновить живой топ группы {group_id}: {e}")
+        return False
+
+    _rendered[group_id] = text
+    return True
+
+async def live_loop(bot, render):
+    """Фоновое обновление живых топов; render(group_id) возвращает текст"""
+    bucket = TokenBucket(min(5, LIVETOP_RATE), LIVETOP_RATE)
+
+    while True:
+        await asyncio.sleep(LIVETOP_INTERVAL)
+        if not _dirty:
+            continue
+
+        batch = list(_dirty)
+        _dirty.clear()
+        for group_id in batch:
+            try:
+                done = await _refresh(bot, render, group_id, bucket)
+            except Exception as e:
+                logger.error(f"Ошибка живого топа группы {group_id}: {e}")
+                done = False
+            if not done:
+                _dirty.add(group_id)
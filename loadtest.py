@@ -0,0 +1,599 @@
+"""Нагрузочный тест ВодкаМера целиком
+
+Поднимает локальный фейковый Bot API, запускает настоящее приложение из main.py
+поверх него и подаёт синтетические апдейты: нажатия кнопок в личке и штормы
+/drink в группах. Бот работает с отдельной временной базой.
+
+Пример:
+    python loadtest.py --rate 200 --duration 30 --users 5000 --groups 20
+
+Режим выносливости (--soak) держит ровную нагрузку часами и раз в
+--sample-interval секунд снимает RSS, размеры кэшей, размер WAL, число
+открытых файлов и перцентили задержки за интервал. Прогон проваливается, если
+память выросла больше --max-rss-growth или задержка p95 поплыла больше чем в
+--max-latency-drift раз:
+    python loadtest.py --soak --rate 50 --duration 14400 --users 200000 --csv soak.csv
+"""
+import argparse
+import asyncio
+import csv
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+import database
+
+TOKEN = '123456:LOADTEST'
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'ВодкаМер', 'username': 'vodka_meter_test_bot'}
+
+BUTTONS = ('drink', 'profile', 'today_top', 'all_top', 'help', 'back')
+
+DRIFT_SAMPLES = 3  # Интервалов в начале и в конце для сравнения задержки
+MAX_FD_GROWTH = 20
+
+def _percentile(sorted_values, p):
+    """Перцентиль по отсортированному списку"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))
+    return sorted_values[index]
+
+def _decode_params(raw, content_type):
+    """Разобрать параметры запроса к Bot API"""
+    if not raw:
+        return {}
+    if 'application/json' in content_type:
+        return json.loads(raw)
+
+    params = {}
+    for key, value in parse_qsl(raw.decode('utf-8'), keep_blank_values=True):
+        # Вложенные объекты PTB передаёт строкой JSON
+        if value[:1] in ('{', '[') or value in ('true', 'false') or value.lstrip('-').isdigit():
+            try:
+                value = json.loads(value)
+            except ValueError:
+                pass
+        params[key] = value
+    return params
+
+class FakeBotAPI:
+    """Локальная замена Bot API: отдаёт апдейты и записывает ответы бота"""
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+        self._cond = threading.Condition()
+        self._updates = deque()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1000)
+
+        # Ожидающие ответа апдейты: ключ -> (время отправки, id апдейта)
+        self._pending = {}
+        self._pending_by_update = {}
+        self.latencies = []
+        self._window = []  # Задержки с прошлого замера - для режима выносливости
+        self.completed = 0
+        self.first_sent = None
+        self.last_completed = None
+        self.calls = Counter()
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/bot'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    @property
+    def pending_count(self):
+        with self._cond:
+            return len(self._pending_by_update)
+
+    def report(self, sent):
+        """Итоги прогона"""
+        with self._cond:
+            latencies = sorted(self.latencies)
+            completed = self.completed
+            elapsed = (self.last_completed or 0) - (self.first_sent or 0)
+            calls = dict(self.calls)
+
+        return {
+            'sent': sent,
+            'completed': completed,
+            'lost': sent - completed,
+            'updates_per_sec': completed / elapsed if elapsed > 0 else 0.0,
+            'latency_ms': {
+                'p50': _percentile(latencies, 50) * 1000,
+                'p95': _percentile(latencies, 95) * 1000,
+                'p99': _percentile(latencies, 99) * 1000,
+                'max': (latencies[-1] if latencies else 0.0) * 1000,
+            },
+            'api_calls': calls,
+        }
+
+    def take_window(self):
+        """Задержки с прошлого вызова, мс"""
+        with self._cond:
+            window, self._window = sorted(self._window), []
+            pending = len(self._pending_by_update)
+
+        return {
+            'completed': len(window),
+            'pending': pending,
+            'p50': _percentile(window, 50) * 1000,
+            'p95': _percentile(window, 95) * 1000,
+            'p99': _percentile(window, 99) * 1000,
+            'max': (window[-1] if window else 0.0) * 1000,
+        }
+
+    # ----- Генерация апдейтов -----
+
+    def _push(self, update, keys):
+        """Поставить апдейт в очередь и ждать ответа по любому из ключей"""
+        with self._cond:
+            now = time.perf_counter()
+            if self.first_sent is None:
+                self.first_sent = now
+            update_id = update['update_id']
+            for key in keys:
+                self._pending[key] = (now, update_id)
+            self._pending_by_update[update_id] = keys
+            self._updates.append(update)
+            self._cond.notify_all()
+
+    def push_button(self, user_id, data):
+        """Нажатие кнопки в личке"""
+        update_id = next(self._update_ids)
+        message_id = next(self._message_ids)
+        query_id = str(update_id)
+        update = {
+            'update_id': update_id,
+            'callback_query': {
+                'id': query_id,
+                'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'username': f'user{user_id}'},
+                'chat_instance': str(user_id),
+                'data': data,
+                'message': {
+                    'message_id': message_id,
+                    'date': int(time.time()),
+                    'chat': {'id': user_id, 'type': 'private', 'first_name': f'User{user_id}'},
+                    'from': BOT_USER,
+                    'text': 'ВодкаМер',
+                },
+            },
+        }
+        # Ответ - правка сообщения или всплывающее окно с кулдауном
+        self._push(update, [('edit', user_id, message_id), ('alert', query_id)])
+
+    def push_command(self, user_id, group_id, command):
+        """Команда в группе"""
+        update_id = next(self._update_ids)
+        message_id = next(self._message_ids)
+        text = '/' + command
+        update = {
+            'update_id': update_id,
+            'message': {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': group_id, 'type': 'supergroup', 'title': f'Group{-group_id}'},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'username': f'user{user_id}'},
+                'text': text,
+                'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}],
+            },
+        }
+        self._push(update, [('reply', group_id, message_id)])
+
+    # ----- Bot API -----
+
+    def _complete(self, key):
+        """Отметить апдейт обработанным"""
+        with self._cond:
+            entry = self._pending.pop(key, None)
+            if entry is None:
+                return
+            sent, update_id = entry
+            for other in self._pending_by_update.pop(update_id, ()):
+                self._pending.pop(other, None)
+            now = time.perf_counter()
+            self.latencies.append(now - sent)
+            self._window.append(now - sent)
+            self.completed += 1
+            self.last_completed = now
+
+    def _get_updates(self, params):
+        offset = params.get('offset') or 0
+        timeout = params.get('timeout') or 0
+        deadline = time.monotonic() + timeout
+
+        with self._cond:
+            # Апдейты до offset бот уже подтвердил
+            while self._updates and self._updates[0]['update_id'] < offset:
+                self._updates.popleft()
+            while not self._updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self._cond.wait(remaining)
+            return list(itertools.islice(self._updates, params.get('limit') or 100))
+
+    def _message(self, chat_id, text, message_id=None):
+        chat_type = 'private' if chat_id > 0 else 'supergroup'
+        return {
+            'message_id': message_id or next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': chat_type},
+            'from': BOT_USER,
+            'text': text,
+        }
+
+    def call(self, method, params):
+        """Выполнить метод Bot API"""
+        self.calls[method] += 1
+
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getUpdates':
+            return self._get_updates(params)
+        if method == 'sendMessage':
+            chat_id = params['chat_id']
+            reply = params.get('reply_parameters') or {}
+            reply_to = reply.get('message_id', params.get('reply_to_message_id'))
+            self._complete(('reply', chat_id, reply_to))
+            return self._message(chat_id, params.get('text', ''))
+        if method == 'editMessageText':
+            chat_id, message_id = params.get('chat_id'), params.get('message_id')
+            self._complete(('edit', chat_id, message_id))
+            return self._message(chat_id, params.get('text', ''), message_id)
+        if method == 'answerCallbackQuery':
+            if params.get('show_alert'):
+                self._complete(('alert', str(params['callback_query_id'])))
+            return True
+        return True
+
+    def _make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                raw = self.rfile.read(length)
+                method = self.path.rsplit('/', 1)[-1]
+                params = _decode_params(raw, self.headers.get('Content-Type', ''))
+
+                body = json.dumps({'ok': True, 'result': api.call(method, params)}).encode('utf-8')
+                try:
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # Бот оборвал long polling при остановке
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+class TrafficGenerator:
+    """Подаёт апдейты в FakeBotAPI с заданной частотой"""
+
+    def __init__(self, api, rate, users, groups, group_share):
+        self.api = api
+        self.rate = rate
+        self.users = users
+        self.groups = groups
+        self.group_share = group_share
+        self.sent = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _one(self):
+        user_id = random.randint(1, self.users)
+        if random.random() < self.group_share:
+            group_id = -1000000000 - random.randint(1, self.groups)
+            self.api.push_command(user_id, group_id, 'drink')
+        else:
+            self.api.push_button(user_id, random.choice(BUTTONS))
+        self.sent += 1
+
+    def _run(self, duration):
+        started = time.perf_counter()
+        while not self._stop.is_set():
+            elapsed = time.perf_counter() - started
+            if duration is not None and elapsed >= duration:
+                break
+            # Догнать расписание: rate апдейтов в секунду
+            due = int(elapsed * self.rate) + 1
+            while self.sent < due:
+                self._one()
+            time.sleep(min(0.01, 1 / self.rate))
+
+    def start(self, duration=None):
+        self._thread = threading.Thread(target=self._run, args=(duration,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    @property
+    def running(self):
+        return self._thread.is_alive()
+
+async def start_bot(base_url, workers=0):
+    """Запустить приложение из main.py поверх фейкового API"""
+    import main
+
+    app = main.build_application(TOKEN, base_url=base_url, workers=workers)
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.updater.start_polling(poll_interval=0, timeout=1)
+    await app.start()
+    return app
+
+async def stop_bot(app):
+    """Остановить приложение"""
+    await app.updater.stop()
+    await app.stop()
+    if app.post_shutdown:
+        await app.post_shutdown(app)
+    await app.shutdown()
+
+def _api_process(conn, args):
+    """Фейковый API и генератор трафика в отдельном процессе, чтобы не делить GIL с ботом"""
+    api = FakeBotAPI()
+    api.start()
+    conn.send(api.base_url)
+
+    # Ждать, пока бот поднимется
+    conn.recv()
+
+    traffic = TrafficGenerator(api, args.rate, args.users, args.groups, args.group_share)
+    traffic.start(args.duration)
+
+    if args.soak:
+        # Задержки за интервал; остальные метрики бот снимает у себя по этому сигналу
+        started = time.monotonic()
+        api.take_window()
+        while True:
+            traffic.join(args.sample_interval)
+            window = api.take_window()
+            # Генератор мог закончить сразу после прошлого замера - пустой хвост не нужен
+            if not traffic.running and not window['completed']:
+                break
+            conn.send(('sample', time.monotonic() - started, window))
+            if not traffic.running:
+                break
+    traffic.join()
+
+    # Дождаться ответов на все отправленные апдейты
+    deadline = time.monotonic() + args.drain_timeout
+    while api.pending_count and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    conn.send(('report', api.report(traffic.sent)))
+
+    # Остановиться только после бота, иначе он упрётся в закрытый порт
+    conn.recv()
+    api.stop()
+
+def _rss_bytes():
+    """Текущий RSS процесса; без /proc - пиковый"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss в килобайтах на Linux и в байтах на macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if os.uname().sysname == 'Darwin' else maxrss * 1024
+
+def _open_files():
+    """Число открытых файловых дескрипторов"""
+    for path in ('/proc/self/fd', '/dev/fd'):
+        try:
+            return len(os.listdir(path))
+        except OSError:
+            continue
+    return None
+
+def _bot_sample(elapsed, window):
+    """Замер состояния бота в этом процессе"""
+    import main
+    from events import bus
+    from throttle import throttler
+
+    try:
+        wal_size = os.path.getsize(database.DB_PATH + '-wal')
+    except OSError:
+        wal_size = 0
+
+    return {
+        'elapsed': round(elapsed, 1),
+        'rss_mb': round(_rss_bytes() / (1024 * 1024), 2),
+        'open_files': _open_files(),
+        'wal_mb': round(wal_size / (1024 * 1024), 2),
+        'user_cache': len(database._user_cache),
+        'group_cache': len(database._group_cache),
+        'known_members': sum(len(members) for members in database._known_members.values()),
+        'rendered_messages': len(main._rendered_messages),
+        'throttle_buckets': len(throttler._buckets),
+        'throttle_replies': len(throttler._replies),
+        'event_queue': bus.queue_depth(),
+        'completed': window['completed'],
+        'pending': window['pending'],
+        'p50_ms': round(window['p50'], 2),
+        'p95_ms': round(window['p95'], 2),
+        'p99_ms': round(window['p99'], 2),
+        'max_ms': round(window['max'], 2),
+    }
+
+def print_sample(sample):
+    """Строка замера режима выносливости"""
+    print(
+        f"[{sample['elapsed']:>8.0f}с] RSS {sample['rss_mb']:.1f}МБ, fd {sample['open_files']}, "
+        f"WAL {sample['wal_mb']:.1f}МБ, кэш польз. {sample['user_cache']}, групп {sample['group_cache']}, "
+        f"обработано {sample['completed']}, в очереди {sample['pending']}, "
+        f"p50 {sample['p50_ms']:.1f}мс, p95 {sample['p95_ms']:.1f}мс, p99 {sample['p99_ms']:.1f}мс",
+        flush=True,
+    )
+
+def _median_p95(samples):
+    return sorted(sample['p95_ms'] for sample in samples)[len(samples) // 2]
+
+def check_soak(samples, args):
+    """Сравнить начало и конец прогона с порогами; вернуть список нарушений"""
+    # Первые замеры - прогрев: кэши и страницы БД только заполняются
+    steady = samples[args.warmup_samples:]
+    if len(steady) < 2:
+        return ["Слишком мало замеров после прогрева - увеличьте --duration"]
+
+    failures = []
+    growth = steady[-1]['rss_mb'] - steady[0]['rss_mb']
+    if growth > args.max_rss_growth:
+        failures.append(f"RSS вырос на {growth:.1f}МБ (порог {args.max_rss_growth:g}МБ)")
+
+    # Медиана по нескольким интервалам в начале и в конце, чтобы один всплеск не ронял прогон
+    span = max(1, min(DRIFT_SAMPLES, len(steady) // 2))
+    before, after = _median_p95(steady[:span]), _median_p95(steady[-span:])
+    if before > 0 and after / before > args.max_latency_drift:
+        failures.append(
+            f"Задержка p95 выросла с {before:.1f}мс до {after:.1f}мс "
+            f"(порог x{args.max_latency_drift:g})"
+        )
+
+    first_fds, last_fds = steady[0]['open_files'], steady[-1]['open_files']
+    if first_fds is not None and last_fds - first_fds > MAX_FD_GROWTH:
+        failures.append(f"Открытых файлов стало больше на {last_fds - first_fds} - утечка соединений?")
+
+    return failures
+
+def write_samples_csv(samples, path):
+    """Временной ряд замеров в CSV"""
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=list(samples[0]))
+        writer.writeheader()
+        writer.writerows(samples)
+
+def setup_environment(workdir):
+    """Временная база и тихие логи"""
+    database.DB_PATH = os.path.join(workdir, 'loadtest.db')
+    database.init_db()
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+async def run_load_test(args):
+    """Прогнать нагрузку и вернуть отчёт"""
+    loop = asyncio.get_running_loop()
+    conn, child_conn = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_api_process, args=(child_conn, args), daemon=True)
+    process.start()
+
+    try:
+        base_url = await loop.run_in_executor(None, conn.recv)
+        app = await start_bot(base_url, args.workers)
+        try:
+            conn.send('go')
+            samples = []
+            while True:
+                message = await loop.run_in_executor(None, conn.recv)
+                if message[0] == 'report':
+                    report = message[1]
+                    break
+                _, elapsed, window = message
+                sample = _bot_sample(elapsed, window)
+                samples.append(sample)
+                print_sample(sample)
+            if args.soak:
+                report['samples'] = samples
+        finally:
+            await stop_bot(app)
+            conn.send('stop')
+    finally:
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+
+    return report
+
+def print_report(report):
+    """Вывести отчёт"""
+    latency = report['latency_ms']
+    print(f"📨 Отправлено: {report['sent']}, обработано: {report['completed']}, потеряно: {report['lost']}")
+    print(f"🚀 Пропускная способность: {report['updates_per_sec']:.1f} апдейтов/с")
+    print(
+        f"⏱ Задержка: p50 {latency['p50']:.1f}мс, p95 {latency['p95']:.1f}мс, "
+        f"p99 {latency['p99']:.1f}мс, max {latency['max']:.1f}мс"
+    )
+    calls = ', '.join(f"{method}={count}" for method, count in sorted(report['api_calls'].items()))
+    print(f"📡 Вызовы API: {calls}")
+
+def main(argv=None):
+    """Точка входа"""
+    parser = argparse.ArgumentParser(description="Нагрузочный тест ВодкаМера")
+    parser.add_argument('--rate', type=float, default=100, help="апдейтов в секунду")
+    parser.add_argument('--duration', type=float, default=30, help="длительность, секунд")
+    parser.add_argument('--users', type=int, default=1000, help="число пользователей")
+    parser.add_argument('--groups', type=int, default=10, help="число групп")
+    parser.add_argument('--group-share', type=float, default=0.5, help="доля /drink в группах")
+    parser.add_argument('--drain-timeout', type=float, default=30, help="сколько ждать хвост ответов")
+    parser.add_argument('--workers', type=int, default=0, help="процессов-воркеров (0 - один процесс)")
+    parser.add_argument('--json', help="сохранить отчёт в JSON")
+    soak = parser.add_argument_group("режим выносливости")
+    soak.add_argument('--soak', action='store_true', help="долгий прогон с замерами памяти и задержки")
+    soak.add_argument('--sample-interval', type=float, default=60, help="секунд между замерами")
+    soak.add_argument('--warmup-samples', type=int, default=2, help="первые замеры не сравнивать")
+    soak.add_argument('--max-rss-growth', type=float, default=50, help="допустимый рост RSS, МБ")
+    soak.add_argument('--max-latency-drift', type=float, default=2.0, help="допустимый рост p95, раз")
+    soak.add_argument('--csv', help="сохранить замеры в CSV")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='vodka-loadtest-')
+    try:
+        setup_environment(workdir)
+        report = asyncio.run(run_load_test(args))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    failures = []
+    if args.soak:
+        samples = report['samples']
+        if args.csv and samples:
+            write_samples_csv(samples, args.csv)
+        failures = check_soak(samples, args)
+        for failure in failures:
+            print(f"❌ {failure}")
+        if not failures:
+            print("✅ Прогон выносливости пройден")
+
+    return 0 if report['lost'] == 0 and not failures else 1
+
+if __name__ == '__main__':
+    raise SystemExit(main())
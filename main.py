@@ -1,10 +1,26 @@
+import asyncio
+import contextvars
 import logging
 import os
+import sqlite3
+from collections import OrderedDict
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, TelegramError
+from telegram.helpers import escape_markdown
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
+import profiler
+from achievements import ACHIEVEMENTS, unlocked_achievements
+import broadcast
+import livetop
+from backup import make_backup, backup_loop
+from events import bus, DrinkRecorded
+from maintenance import maintenance_loop, migrate_times, db_stats, format_stats, enable_incremental_vacuum
+from snapshot import discard_snapshot, load_snapshot, read_snapshot, save_snapshot
+from throttle import throttled, reply_cached, throttler
+from workers import WorkerPool, WORKER_PROCESSES
 from database import (
-    init_db, get_or_create_user, get_user_data, add_drink, 
+    init_db, load_registry, get_or_create_user, get_user_data, add_drink, 
     get_leaderboard, get_today_leaderboard, calculate_level, update_level,
     can_drink, add_vodka, remove_vodka, add_levels, get_user_by_username,
     add_group, add_user_to_group, add_group_drink, get_group_top, get_group_info
@@ -41,6 +57,10 @@ LEVELS = {
     6: ("Легенда", "🌟")
 }
 
+# Последний отправленный текст сообщений: (chat_id, message_id) -> (текст, клавиатура)
+_rendered_messages = OrderedDict()
+RENDERED_CACHE_SIZE = 10000
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /start"""
     user = update.effective_user
@@ -90,6 +110,30 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(welcome_text, reply_markup=reply_markup, parse_mode='Markdown')
 
+async def _edit_message(query, text, reply_markup=None, parse_mode=None):
+    """Отредактировать сообщение, пропуская правки без изменений"""
+    if query.message:
+        message_key = (query.message.chat.id, query.message.message_id)
+    else:
+        message_key = query.inline_message_id
+    
+    rendered = (text, reply_markup.to_json() if reply_markup else None)
+    
+    # Telegram всё равно отклонит такую правку ("message is not modified")
+    if _rendered_messages.get(message_key) == rendered:
+        return
+    
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+    except BadRequest as e:
+        if 'message is not modified' not in str(e).lower():
+            raise
+    
+    _rendered_messages[message_key] = rendered
+    _rendered_messages.move_to_end(message_key)
+    if len(_rendered_messages) > RENDERED_CACHE_SIZE:
+        _rendered_messages.popitem(last=False)
+
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка кнопок"""
     query = update.callback_query
@@ -113,14 +157,24 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif query.data == 'back':
         await back_to_menu(query)
 
+def _format_unlocked(unlocked):
+    """Строки о новых достижениях для сообщения о рюмке"""
+    if not unlocked:
+        return ""
+    return "\n".join(f"🏆 *Новое достижение:* {a.title}" for a in unlocked) + "\n"
+
 async def handle_drink(query):
     """Обработка нажатия кнопки выпить"""
     user_id = query.from_user.id
     
-    # Проверить может ли пить
+    # Проверить может ли пить; add_drink перепроверяет это в своей транзакции
     can_drink_now, minutes_left = can_drink(user_id)
+    drink = add_drink(user_id) if can_drink_now else None
     
-    if not can_drink_now:
+    if drink is None:
+        if can_drink_now:
+            # Рюмку только что записал другой воркер
+            _, minutes_left = can_drink(user_id)
         hours = minutes_left // 60
         mins = minutes_left % 60
         message_text = f"""
@@ -134,12 +188,15 @@ async def handle_drink(query):
         await query.answer(f"Ждать ещё {hours}ч {mins}мин!", show_alert=True)
         return
     
-    vodka_gain = add_drink(user_id)
-    update_level(user_id)
+    vodka_gain, unlocked, _ = drink
     
     user_data = get_user_data(user_id)
-    total, today, level = user_data[2], user_data[3], user_data[7]
-    vodka_total = user_data[9]
+    total, today = user_data[2], user_data[3]
+    vodka_total = user_data[8]
+    
+    # Уровень в БД обновит подписчик, для ответа он считается сразу
+    level = calculate_level(total)
+    await bus.publish(DrinkRecorded(user_id, total, vodka_gain))
     
     level_name, level_emoji = LEVELS.get(level, ("Неизвестно", "❓"))
     
@@ -166,7 +223,7 @@ async def handle_drink(query):
 🏆 *Всего:* {total} рюмок
 🌊 *Водка:* {vodka_total:.1f}л 💧
 {level_emoji} *Уровень:* {level_name}
-
+{_format_unlocked(unlocked)}
 💬 Следующую можешь выпить через 5 часов!
 """
     
@@ -177,7 +234,7 @@ async def handle_drink(query):
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await query.edit_message_text(message_text, reply_markup=reply_markup, parse_mode='Markdown')
+    await _edit_message(query, message_text, reply_markup=reply_markup, parse_mode='Markdown')
 
 async def handle_profile(query):
     """Обработка профиля"""
@@ -185,11 +242,11 @@ async def handle_profile(query):
     user_data = get_user_data(user_id)
     
     if not user_data:
-        await query.edit_message_text("Ошибка! Пользователь не найден.")
+        await _edit_message(query, "Ошибка! Пользователь не найден.")
         return
     
-    username, total, today, level = user_data[1], user_data[2], user_data[3], user_data[7]
-    vodka_total = user_data[9]
+    username, total, today, level = user_data[1], user_data[2], user_data[3], user_data[6]
+    vodka_total = user_data[8]
     level_name, level_emoji = LEVELS.get(level, ("Неизвестно", "❓"))
     
     # Прогресс до следующего уровня
@@ -201,6 +258,9 @@ async def handle_profile(query):
     
     progress_bar = "▓" * min(10, int((progress / needed) * 10)) + "░" * (10 - min(10, int((progress / needed) * 10)))
     
+    achievements = unlocked_achievements(user_data[10] or 0)
+    achievements_text = "\n".join(f"  {a.title}" for a in achievements) or "  Пока нет - пей и открывай!"
+    
     message_text = f"""
 👤 *Твой профиль*
 
@@ -216,6 +276,9 @@ async def handle_profile(query):
 `{progress_bar}`
 {progress}/{needed} рюмок
 
+🏆 *Достижения ({len(achievements)}/{len(ACHIEVEMENTS)}):*
+{achievements_text}
+
 🎯 *Цель:* Достичь уровня Легенда и выпить 1000 рюмок!
 """
     
@@ -225,7 +288,7 @@ async def handle_profile(query):
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await query.edit_message_text(message_text, reply_markup=reply_markup, parse_mode='Markdown')
+    await _edit_message(query, message_text, reply_markup=reply_markup, parse_mode='Markdown')
 
 async def handle_today_top(query):
     """Топ за сегодня"""
@@ -251,7 +314,7 @@ async def handle_today_top(query):
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await query.edit_message_text(message_text, reply_markup=reply_markup, parse_mode='Markdown')
+    await _edit_message(query, message_text, reply_markup=reply_markup, parse_mode='Markdown')
 
 async def handle_all_top(query):
     """Общий топ"""
@@ -278,7 +341,7 @@ async def handle_all_top(query):
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await query.edit_message_text(message_text, reply_markup=reply_markup, parse_mode='Markdown')
+    await _edit_message(query, message_text, reply_markup=reply_markup, parse_mode='Markdown')
 
 async def handle_help(query):
     """Справка"""
@@ -314,7 +377,7 @@ async def handle_help(query):
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await query.edit_message_text(message_text, reply_markup=reply_markup, parse_mode='Markdown')
+    await _edit_message(query, message_text, reply_markup=reply_markup, parse_mode='Markdown')
 
 async def back_to_menu(query):
     """Вернуться в главное меню"""
@@ -333,7 +396,7 @@ async def back_to_menu(query):
 Выбери действие:
 """
     
-    await query.edit_message_text(message_text, reply_markup=reply_markup, parse_mode='Markdown')
+    await _edit_message(query, message_text, reply_markup=reply_markup, parse_mode='Markdown')
 
 # ===== ГРУППОВЫЕ КОМАНДЫ =====
 
@@ -346,10 +409,14 @@ async def group_drink(update: Update, context: ContextTypes.DEFAULT_TYPE):
     add_group(group.id, group.title)
     add_user_to_group(group.id, user.id)
     
-    # Проверить может ли пить
+    # Проверить может ли пить; add_drink перепроверяет это в своей транзакции
     can_drink_now, minutes_left = can_drink(user.id)
+    drink = add_drink(user.id) if can_drink_now else None
     
-    if not can_drink_now:
+    if drink is None:
+        if can_drink_now:
+            # Рюмку только что записал другой воркер
+            _, minutes_left = can_drink(user.id)
         hours = minutes_left // 60
         mins = minutes_left % 60
         await update.message.reply_text(
@@ -359,13 +426,15 @@ async def group_drink(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    vodka_gain = add_drink(user.id)
-    add_group_drink(group.id, user.id)
-    update_level(user.id)
+    vodka_gain, unlocked, mask = drink
     
     user_data = get_user_data(user.id)
-    total, level = user_data[2], user_data[7]
-    vodka_total = user_data[9]
+    total = user_data[2]
+    vodka_total = user_data[8]
+    
+    # Счётчик группы и уровень обновят подписчики, групповые достижения придут отдельным сообщением
+    level = calculate_level(total)
+    await bus.publish(DrinkRecorded(user.id, total, vodka_gain, group.id, mask))
     
     level_name, level_emoji = LEVELS.get(level, ("?", "❓"))
     
@@ -378,10 +447,11 @@ async def group_drink(update: Update, context: ContextTypes.DEFAULT_TYPE):
 📊 *Всего:* {total} рюмок
 🌊 *Водка:* {vodka_total:.1f}л
 {level_emoji} *Уровень:* {level_name}
-"""
+{_format_unlocked(unlocked)}"""
     
     await update.message.reply_text(message_text, parse_mode='Markdown')
 
+@throttled('profile')
 async def group_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /profile в группе"""
     user = update.effective_user
@@ -393,9 +463,10 @@ async def group_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Ошибка! Пользователь не найден.")
         return
     
-    total, level = user_data[2], user_data[7]
-    vodka_total = user_data[9]
+    total, level = user_data[2], user_data[6]
+    vodka_total = user_data[8]
     level_name, level_emoji = LEVELS.get(level, ("?", "❓"))
+    achievements = unlocked_achievements(user_data[10] or 0)
     
     message_text = f"""
 👤 *Профиль {user.first_name}*
@@ -403,19 +474,15 @@ async def group_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
 {level_emoji} *Уровень:* {level_name} ({level}/6)
 🍺 *Выпито:* {total} рюмок
 💧 *Водка:* {vodka_total:.1f}л
+🏆 *Достижения:* {len(achievements)}/{len(ACHIEVEMENTS)}
 """
     
-    await update.message.reply_text(message_text, parse_mode='Markdown')
+    await reply_cached(update, 'profile', message_text, parse_mode='Markdown')
 
-async def group_top(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда /grouptop - топ в группе"""
-    group = update.effective_chat
-    
-    add_group(group.id, group.title)
-    
-    leaderboard = get_group_top(group.id, 10)
-    
-    message_text = f"{FIRE_EMOJI} *Топ в группе {group.title}* {FIRE_EMOJI}\n\n"
+def _format_group_top(title, leaderboard):
+    """Текст топа группы"""
+    # Имена экранируются и стоят вне *...*: в Markdown экранирование работает только вне сущностей
+    message_text = f"{FIRE_EMOJI} *Топ в группе* {escape_markdown(title or '')} {FIRE_EMOJI}\n\n"
     
     medals = ["🥇", "🥈", "🥉"]
     
@@ -425,11 +492,91 @@ async def group_top(update: Update, context: ContextTypes.DEFAULT_TYPE):
         for i, (username, drinks, level) in enumerate(leaderboard, 1):
             medal = medals[i-1] if i <= 3 else f"{i}️⃣"
             level_name, level_emoji = LEVELS.get(level, ("?", "❓"))
-            name = username or f"Пользователь"
-            message_text += f"{medal} *{name}* — {drinks} рюмок {level_emoji}\n"
+            name = escape_markdown(username or "Пользователь")
+            message_text += f"{medal} {name} — *{drinks}* рюмок {level_emoji}\n"
     
-    await update.message.reply_text(message_text, parse_mode='Markdown')
+    return message_text
 
+def _render_live_top(group_id):
+    """Текст живого топа - вызывается из фонового цикла"""
+    group_info = get_group_info(group_id)
+    title = group_info[0] if group_info else ""
+    return _format_group_top(title, get_group_top(group_id, 10)) + "\n🔄 _Обновляется сам_"
+
+@throttled('grouptop')
+async def group_top(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /grouptop - топ в группе"""
+    group = update.effective_chat
+    
+    add_group(group.id, group.title)
+    
+    # Живой топ уже закреплён - не строить его заново
+    live_message_id = livetop.live_message(group.id)
+    if live_message_id:
+        await update.message.reply_text(
+            "📌 Топ группы закреплён и обновляется сам", reply_to_message_id=live_message_id
+        )
+        return
+    
+    message_text = _format_group_top(group.title, get_group_top(group.id, 10))
+    
+    await reply_cached(update, 'grouptop', message_text, parse_mode='Markdown')
+
+async def _can_manage_live_top(update, context):
+    """Включать живой топ могут админы группы и админ бота"""
+    user = update.effective_user
+    if is_admin(user.username):
+        return True
+    member = await context.bot.get_chat_member(update.effective_chat.id, user.id)
+    return member.status in ('administrator', 'creator')
+
+async def group_live_top(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /livetop [off] - закреплённый топ, который обновляется сам"""
+    group = update.effective_chat
+    if group.type == 'private':
+        await update.message.reply_text("❌ Живой топ работает только в группах")
+        return
+    
+    if not await _can_manage_live_top(update, context):
+        await update.message.reply_text("❌ Живой топ включают админы группы")
+        return
+    
+    add_group(group.id, group.title)
+    
+    if context.args and context.args[0].lower() == 'off':
+        message_id = livetop.disable(group.id)
+        if message_id is None:
+            await update.message.reply_text("Живой топ и так выключен")
+            return
+        try:
+            await context.bot.unpin_chat_message(group.id, message_id=message_id)
+        except BadRequest:
+            pass
+        await update.message.reply_text("🛑 Живой топ выключен")
+        return
+    
+    if livetop.live_message(group.id):
+        await update.message.reply_text(
+            "📌 Живой топ уже включен. Выключить: /livetop off",
+            reply_to_message_id=livetop.live_message(group.id)
+        )
+        return
+    
+    text = _render_live_top(group.id)
+    try:
+        message = await context.bot.send_message(group.id, text, parse_mode='Markdown')
+    except TelegramError as e:
+        logger.warning(f"Не удалось отправить живой топ в группу {group.id}: {e}")
+        await update.message.reply_text("❌ Не получилось отправить живой топ, попробуйте позже")
+        return
+    livetop.enable(group.id, message.message_id, text)
+    
+    try:
+        await context.bot.pin_chat_message(group.id, message.message_id, disable_notification=True)
+    except BadRequest:
+        await update.message.reply_text("📌 Дайте боту право закреплять сообщения - топ будет наверху")
+
+@throttled('groupstats')
 async def group_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /groupstats - статистика группы"""
     group = update.effective_chat
@@ -452,7 +599,7 @@ async def group_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
 Напоминание: рюмку можно выпить раз в 5 часов! ⏳
 """
     
-    await update.message.reply_text(message_text, parse_mode='Markdown')
+    await reply_cached(update, 'groupstats', message_text, parse_mode='Markdown')
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка ошибок"""
@@ -487,7 +634,7 @@ async def admin_vodka(update: Update, context: ContextTypes.DEFAULT_TYPE):
         add_vodka(target_user_id, amount)
         
         user_data = get_user_data(target_user_id)
-        vodka_total = user_data[9]
+        vodka_total = user_data[8]
         
         await update.message.reply_text(
             f"✅ Админ добавил {amount}л водки пользователю {target_username}!\n"
@@ -512,6 +659,46 @@ async def admin_donat(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='Markdown'
     )
 
+async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /broadcast - админ делает рассылку: /broadcast users (текст)"""
+    if not is_admin(update.effective_user.username):
+        await update.message.reply_text("❌ У тебя нет прав! Эта команда только для админа.")
+        return
+    
+    if not context.args:
+        await update.message.reply_text(
+            "❌ Использование: /broadcast (users|groups) (текст)\n"
+            "Пример: /broadcast users 🍺 Новый сезон!\n"
+            "/broadcast status - ход рассылки\n/broadcast stop - остановить"
+        )
+        return
+    
+    if context.args[0] == 'status':
+        await update.message.reply_text(broadcast.last_status())
+        return
+    
+    if context.args[0] == 'stop':
+        stopped = await broadcast.stop_broadcast()
+        if stopped is None:
+            await update.message.reply_text("Сейчас рассылки нет")
+        else:
+            await update.message.reply_text(f"⏹ Рассылка #{stopped.id} остановлена\n\n{broadcast.format_status(stopped)}")
+        return
+    
+    # Текст берём из сообщения целиком, чтобы сохранить переносы строк
+    parts = update.message.text.split(None, 2)
+    if len(parts) < 3:
+        await update.message.reply_text("❌ Нужен текст рассылки!")
+        return
+    
+    try:
+        broadcast_id = broadcast.start_broadcast(context.bot, parts[1], parts[2], update.effective_chat.id)
+    except (ValueError, RuntimeError) as e:
+        await update.message.reply_text(f"❌ {e}")
+        return
+    
+    await update.message.reply_text(f"📣 Рассылка #{broadcast_id} запущена. Отчёт придёт сюда.")
+
 async def admin_lvlup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /lvlup - админ повышает уровень: /lvlup 10 (ник)"""
     if not is_admin(update.effective_user.username):
@@ -534,7 +721,7 @@ async def admin_lvlup(update: Update, context: ContextTypes.DEFAULT_TYPE):
         add_levels(target_user_id, levels)
         
         user_data = get_user_data(target_user_id)
-        new_level = user_data[7]
+        new_level = user_data[6]
         level_name, level_emoji = LEVELS.get(new_level, ("Неизвестно", "❓"))
         
         await update.message.reply_text(
@@ -570,7 +757,7 @@ async def admin_remove_vodka(update: Update, context: ContextTypes.DEFAULT_TYPE)
         remove_vodka(target_user_id, amount)
         
         user_data = get_user_data(target_user_id)
-        vodka_total = user_data[9]
+        vodka_total = user_data[8]
         
         await update.message.reply_text(
             f"✅ Админ отнял {amount}л водки у пользователя {target_username}!\n"
@@ -579,35 +766,320 @@ async def admin_remove_vodka(update: Update, context: ContextTypes.DEFAULT_TYPE)
     except ValueError:
         await update.message.reply_text("❌ Количество должно быть числом!")
 
-def main():
-    """Главная функция"""
-    # Инициализация БД
-    init_db()
+async def admin_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /backup - админ делает бэкап БД"""
+    if not is_admin(update.effective_user.username):
+        await update.message.reply_text("❌ У тебя нет прав! Эта команда только для админа.")
+        return
     
-    # Получить токен бота
-    token = os.getenv('TELEGRAM_BOT_TOKEN')
-    if not token:
-        raise ValueError("TELEGRAM_BOT_TOKEN не найден в .env файле!")
+    await update.message.reply_text("⏳ Делаю бэкап базы...")
     
-    # Создать приложение
-    app = Application.builder().token(token).build()
+    try:
+        loop = asyncio.get_running_loop()
+        path, size, seconds = await loop.run_in_executor(None, make_backup)
+    except (RuntimeError, sqlite3.Error, OSError) as e:
+        await update.message.reply_text(f"❌ Бэкап не удался: {e}")
+        return
+    
+    await update.message.reply_text(
+        f"✅ Бэкап готов: {path}\n"
+        f"Размер: {size / 1024 / 1024:.1f}МБ, время: {seconds:.1f}с"
+    )
+
+async def admin_dbstats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /dbstats [vacuum] - админ смотрит состояние файла БД или включает вакуум"""
+    if not is_admin(update.effective_user.username):
+        await update.message.reply_text("❌ У тебя нет прав! Эта команда только для админа.")
+        return
+    
+    loop = asyncio.get_running_loop()
+    
+    if context.args and context.args[0] == 'vacuum':
+        # VACUUM переписывает весь файл - сначала бэкап
+        await update.message.reply_text("⏳ Делаю бэкап и перевожу БД на incremental vacuum...")
+        try:
+            await loop.run_in_executor(None, make_backup)
+            before, after = await loop.run_in_executor(None, enable_incremental_vacuum)
+        except (RuntimeError, sqlite3.Error, OSError) as e:
+            await update.message.reply_text(f"❌ Не удалось: {e}")
+            return
+        await update.message.reply_text(f"✅ auto_vacuum: {before} → {after}")
+        return
+    
+    stats = await loop.run_in_executor(None, db_stats)
+    await update.message.reply_text(f"🗄 Состояние БД\n\n{format_stats(stats)}")
+
+async def admin_throttle(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /throttle - админ смотрит счётчики лимитов"""
+    if not is_admin(update.effective_user.username):
+        await update.message.reply_text("❌ У тебя нет прав! Эта команда только для админа.")
+        return
+    
+    # Корзины живут в воркерах, у фронтенда своих нет
+    if _worker_pool is not None:
+        await update.message.reply_text(
+            "❌ С пулом воркеров у каждого воркера свои лимиты, общей картины нет. "
+            "Счётчики доступны с WORKER_PROCESSES=0."
+        )
+        return
+    
+    await update.message.reply_text(f"🚦 Лимиты запросов\n\n{throttler.stats()}")
+
+async def admin_events(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /events - админ смотрит очереди шины событий"""
+    if not is_admin(update.effective_user.username):
+        await update.message.reply_text("❌ У тебя нет прав! Эта команда только для админа.")
+        return
+    
+    # Шина работает в каждом воркере отдельно
+    if _worker_pool is not None:
+        await update.message.reply_text(
+            "❌ С пулом воркеров у каждого воркера своя шина событий, общей картины нет. "
+            "Счётчики доступны с WORKER_PROCESSES=0."
+        )
+        return
+    
+    await update.message.reply_text(f"📬 Шина событий\n\n{bus.stats()}")
+
+def _parse_profile_limit(arg):
+    """Лимит профилирования: 200 - апдейтов, 30s / 5m - время"""
+    if arg[-1] in 'sm':
+        seconds = int(arg[:-1]) * (60 if arg[-1] == 'm' else 1)
+        return 0, seconds
+    return int(arg), 0
+
+async def admin_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /prof - админ профилирует бота: /prof cpu 200 | /prof wall 60s | /prof off"""
+    if not is_admin(update.effective_user.username):
+        await update.message.reply_text("❌ У тебя нет прав! Эта команда только для админа.")
+        return
+    
+    # Апдейты обрабатывают воркеры, во фронтенде профилировать нечего
+    if _worker_pool is not None:
+        await update.message.reply_text(
+            "❌ Профилирование недоступно с пулом воркеров. "
+            "Запусти бота с WORKER_PROCESSES=0 и повтори /prof."
+        )
+        return
+    
+    if not context.args:
+        await update.message.reply_text(
+            f"{profiler.status()}\n\n"
+            "Использование: /prof (cpu|wall) (апдейтов или 30s/5m) [каждый N-й]\n"
+            "Пример: /prof cpu 200 5\n/prof wall 60s\n/prof off"
+        )
+        return
+    
+    if context.args[0] == 'off':
+        if not profiler.is_active():
+            await update.message.reply_text("Профилирование и так выключено")
+            return
+        await profiler.stop_session()
+        return
+    
+    try:
+        mode = context.args[0]
+        max_updates, seconds = _parse_profile_limit(context.args[1] if len(context.args) > 1 else '100')
+        sample_every = int(context.args[2]) if len(context.args) > 2 else 1
+        profiler.start_session(
+            context.application, globals(), mode,
+            max_updates=max_updates, seconds=seconds,
+            sample_every=sample_every, chat_id=update.effective_chat.id
+        )
+    except (ValueError, RuntimeError) as e:
+        await update.message.reply_text(f"❌ {e}")
+        return
+    
+    await update.message.reply_text(f"✅ {profiler.status()}. Отчёт придёт сюда.")
+
+# ===== ФОНОВЫЕ ЗАДАЧИ =====
+
+_background_tasks = []
+
+# ===== ПОДПИСЧИКИ СОБЫТИЙ =====
+
+async def _level_on_drink(event):
+    """Пересчитать уровень после рюмки"""
+    # copy_context: пул потоков не переносит контекст, а по нему профилировщик считает время БД
+    await asyncio.get_running_loop().run_in_executor(
+        None, contextvars.copy_context().run, update_level, event.user_id
+    )
+    # Подписчик группы мог перерисовать живой топ до записи уровня - перерисовать ещё раз
+    if event.group_id is not None:
+        livetop.mark_dirty(event.group_id)
+
+def _subscribe(bot):
+    """Подписчики на рюмку; bot нужен для уведомлений"""
+    async def group_on_drink(event):
+        """Счётчик группы и групповые достижения"""
+        if event.group_id is None:
+            return
+        loop = asyncio.get_running_loop()
+        unlocked = await loop.run_in_executor(
+            None, contextvars.copy_context().run, add_group_drink,
+            event.group_id, event.user_id, event.achievements_mask
+        )
+        livetop.mark_dirty(event.group_id)
+        if unlocked:
+            user_data = await loop.run_in_executor(
+                None, contextvars.copy_context().run, get_user_data, event.user_id
+            )
+            name = escape_markdown(str(user_data[1] if user_data else event.user_id))
+            await bot.send_message(
+                event.group_id, f"{name}\n{_format_unlocked(unlocked)}", parse_mode='Markdown'
+            )
+    
+    bus.clear()
+    bus.subscribe(DrinkRecorded, _level_on_drink, name='level')
+    bus.subscribe(DrinkRecorded, group_on_drink, name='group')
+
+# Пул процессов-воркеров, если бот запущен с WORKER_PROCESSES > 0
+_worker_pool = None
+
+def _start_chat_services(application):
+    """Всё, что связано с чатами: подписчики рюмок и живой топ"""
+    _subscribe(application.bot)
+    bus.start()
+    
+    livetop.load()
+    _background_tasks.append(asyncio.create_task(livetop.live_loop(application.bot, _render_live_top)))
+
+def _start_global_services(application):
+    """Задачи на всю базу - в одном процессе"""
+    _background_tasks.append(asyncio.create_task(backup_loop()))
+    _background_tasks.append(asyncio.create_task(maintenance_loop()))
+    _background_tasks.append(asyncio.create_task(migrate_times()))
+    
+    # Продолжить рассылку, прерванную остановкой или падением
+    broadcast.resume_broadcast(application.bot)
+
+async def _cancel_background_tasks():
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+
+async def post_init(application: Application):
+    """Запуск фоновых задач после старта бота"""
+    _start_chat_services(application)
+    _start_global_services(application)
+
+async def front_post_init(application: Application):
+    """Фронтенд пула: фоновые задачи и воркеры, чаты обрабатывают воркеры"""
+    _start_global_services(application)
+    await _worker_pool.start(application)
+
+async def worker_post_init(application: Application):
+    """Воркер пула: только обработка своих чатов"""
+    _start_chat_services(application)
+
+async def worker_post_shutdown(application: Application):
+    """Остановка воркера: дописать рюмки из очередей"""
+    await bus.stop()
+    await _cancel_background_tasks()
+
+async def front_post_shutdown(application: Application):
+    """Остановка фронтенда: сначала воркеры дообрабатывают свои апдейты"""
+    await _worker_pool.stop()
+    await broadcast.suspend_broadcast()
+    await _cancel_background_tasks()
+    
+    # В БД писали воркеры, кэши фронтенда этого не видели - снимок из них был бы
+    # устаревшим, а старый снимок однопроцессного запуска больше не нужен
+    discard_snapshot()
+
+async def post_shutdown(application: Application):
+    """Остановка фоновых задач"""
+    # Рассылка остаётся в статусе running и продолжится при запуске
+    await broadcast.suspend_broadcast()
+    
+    # Дописать рюмки из очередей до снимка кэшей
+    await bus.stop()
+    await _cancel_background_tasks()
+    
+    # Снимок кэшей для тёплого старта
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, save_snapshot)
+    except (sqlite3.Error, OSError) as e:
+        logger.error(f"Не удалось сохранить снимок кэша: {e}")
+
+def build_application(token, base_url=None, workers=0, request=None):
+    """Создать приложение с зарегистрированными обработчиками
+
+    workers - число процессов-воркеров (0 - всё в этом процессе);
+    request - HTTP-клиент воркера пула, через который идут вызовы API.
+    """
+    global _worker_pool
+    
+    if request is not None:
+        hooks = (worker_post_init, worker_post_shutdown)
+    elif workers:
+        hooks = (front_post_init, front_post_shutdown)
+    else:
+        hooks = (post_init, post_shutdown)
+    
+    builder = (
+        Application.builder()
+        .token(token)
+        .post_init(hooks[0])
+        .post_shutdown(hooks[1])
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    if request is not None:
+        # Воркер не опрашивает Telegram сам - апдейты приходят от фронтенда
+        builder = builder.request(request).get_updates_request(request).updater(None)
+    app = builder.build()
+    
+    if workers and request is None:
+        _worker_pool = WorkerPool(workers, token, base_url)
+        _worker_pool.attach(app)
     
     # Регистрация обработчиков
     app.add_handler(CommandHandler('start', start))
     app.add_handler(CommandHandler('vodka', admin_vodka))
     app.add_handler(CommandHandler('donat', admin_donat))
+    app.add_handler(CommandHandler('broadcast', admin_broadcast))
     app.add_handler(CommandHandler('lvlup', admin_lvlup))
     app.add_handler(CommandHandler('removevodka', admin_remove_vodka))
+    app.add_handler(CommandHandler('backup', admin_backup))
+    app.add_handler(CommandHandler('prof', admin_profile))
+    app.add_handler(CommandHandler('throttle', admin_throttle))
+    app.add_handler(CommandHandler('dbstats', admin_dbstats))
+    app.add_handler(CommandHandler('events', admin_events))
     
     # Групповые команды
     app.add_handler(CommandHandler('drink', group_drink))
     app.add_handler(CommandHandler('profile', group_profile))
     app.add_handler(CommandHandler('grouptop', group_top))
     app.add_handler(CommandHandler('groupstats', group_stats))
+    app.add_handler(CommandHandler('livetop', group_live_top))
     
     app.add_handler(CallbackQueryHandler(button_handler))
     app.add_error_handler(error_handler)
     
+    return app
+
+def main():
+    """Главная функция"""
+    # Тёплый старт: отпечаток файла проверяется до первого соединения с БД,
+    # а форма строк - уже после миграций. В пуле кэши фронтенда не снимаются
+    snapshot = None if WORKER_PROCESSES else read_snapshot()
+    
+    # Инициализация БД
+    init_db()
+    warm_start = load_snapshot(snapshot)
+    if not warm_start:
+        load_registry()
+    
+    # Получить токен бота
+    token = os.getenv('TELEGRAM_BOT_TOKEN')
+    if not token:
+        raise ValueError("TELEGRAM_BOT_TOKEN не найден в .env файле!")
+    
+    # Создать приложение
+    app = build_application(token, workers=WORKER_PROCESSES)
+    
     # Запуск бота
     logger.info("🤖 Бот запущен!")
     print(f"{VODKA_EMOJI} ВодкаМер запущен! {VODKA_EMOJI}")
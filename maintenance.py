@@ -0,0 +1,226 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime
+
+import database
+
+logger = logging.getLogger(__name__)
+
+# Настройки обслуживания БД
+MAINTENANCE_INTERVAL_MINUTES = float(os.getenv('MAINTENANCE_INTERVAL_MINUTES', '10'))
+OPTIMIZE_INTERVAL_HOURS = float(os.getenv('OPTIMIZE_INTERVAL_HOURS', '6'))
+WAL_CHECKPOINT_MB = float(os.getenv('WAL_CHECKPOINT_MB', '16'))  # Порог размера -wal файла
+QUIET_HOURS = os.getenv('QUIET_HOURS', '4-6')  # Тихие часы для вакуума, локальное время
+VACUUM_PAGES_PER_STEP = 200  # Страниц за один шаг incremental_vacuum
+VACUUM_STEP_PAUSE = 0.1
+ANALYSIS_LIMIT = 1000  # Строк на индекс для ANALYZE, чтобы он не читал таблицы целиком
+
+MIGRATION_BATCH = 1000  # Строк за один шаг переноса дат
+MIGRATION_PAUSE = 0.05
+
+BUSY_TIMEOUT_MS = 1000  # Не ждать блокировок долго - лучше пропустить шаг
+
+AUTO_VACUUM_MODES = {0: 'NONE', 1: 'FULL', 2: 'INCREMENTAL'}
+
+# Когда что последний раз делалось
+_last_runs = {}
+
+def _connect():
+    """Отдельное соединение для обслуживания, без _db_lock"""
+    conn = sqlite3.connect(database.DB_PATH, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+    conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+    return conn
+
+def _pragma(conn, name):
+    return conn.execute(f'PRAGMA {name}').fetchone()[0]
+
+def _wal_size():
+    """Размер -wal файла в байтах"""
+    try:
+        return os.path.getsize(database.DB_PATH + '-wal')
+    except OSError:
+        return 0
+
+def _in_quiet_hours(now=None):
+    """Сейчас тихие часы?"""
+    start, end = (int(hour) for hour in QUIET_HOURS.split('-'))
+    hour = (now or datetime.now()).hour
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+def analyze_if_needed(conn):
+    """ANALYZE, если статистики для планировщика ещё нет"""
+    has_stats = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'"
+    ).fetchone()
+    if has_stats and conn.execute('SELECT 1 FROM sqlite_stat1 LIMIT 1').fetchone():
+        return False
+
+    conn.execute(f'PRAGMA analysis_limit = {ANALYSIS_LIMIT}')
+    conn.execute('ANALYZE')
+    _last_runs['analyze'] = datetime.now()
+    return True
+
+def optimize(conn):
+    """PRAGMA optimize - пересчитывает статистику только там, где она устарела"""
+    conn.execute(f'PRAGMA analysis_limit = {ANALYSIS_LIMIT}')
+    conn.execute('PRAGMA optimize')
+    _last_runs['optimize'] = datetime.now()
+
+def checkpoint(conn, mode='PASSIVE'):
+    """Перенести WAL в основной файл; PASSIVE никого не ждёт и не блокирует"""
+    busy, log_frames, checkpointed = conn.execute(f'PRAGMA wal_checkpoint({mode})').fetchone()
+    _last_runs['checkpoint'] = datetime.now()
+    return busy, log_frames, checkpointed
+
+def incremental_vacuum(conn, max_pages):
+    """Вернуть свободные страницы ОС небольшими шагами"""
+    if _pragma(conn, 'auto_vacuum') != 2:
+        return 0
+
+    freed = 0
+    while freed < max_pages:
+        free = _pragma(conn, 'freelist_count')
+        if not free:
+            break
+        step = min(VACUUM_PAGES_PER_STEP, free, max_pages - freed)
+        # executescript проходит прагму до конца, execute освобождает одну страницу
+        conn.executescript(f'PRAGMA incremental_vacuum({step});')
+        freed += step
+        # Дать записи рюмок пройти между шагами
+        time.sleep(VACUUM_STEP_PAUSE)
+
+    _last_runs['vacuum'] = datetime.now()
+    return freed
+
+def enable_incremental_vacuum():
+    """Один раз перевести БД на auto_vacuum = INCREMENTAL, вернуть (режим до, режим после)
+
+    PRAGMA в init_db действует только на новую БД: существующую переводит VACUUM,
+    который переписывает весь файл и всё это время не пускает запись. Запускать
+    после бэкапа, лучше в тихие часы.
+    """
+    # Под _db_lock запись бота ждёт, а не падает с database is locked
+    with database._db_lock:
+        conn = sqlite3.connect(database.DB_PATH, isolation_level=None)
+        try:
+            before = _pragma(conn, 'auto_vacuum')
+            if before != 2:
+                conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                conn.execute('VACUUM')
+            after = _pragma(conn, 'auto_vacuum')
+        finally:
+            conn.close()
+
+    _last_runs['vacuum'] = datetime.now()
+    return AUTO_VACUUM_MODES.get(before, str(before)), AUTO_VACUUM_MODES.get(after, str(after))
+
+def run_maintenance(now=None):
+    """Один проход обслуживания"""
+    now = now or datetime.now()
+    quiet = _in_quiet_hours(now)
+    conn = _connect()
+
+    try:
+        analyze_if_needed(conn)
+
+        last_optimize = _last_runs.get('optimize')
+        if last_optimize is None or (now - last_optimize).total_seconds() >= OPTIMIZE_INTERVAL_HOURS * 3600:
+            optimize(conn)
+
+        if quiet:
+            incremental_vacuum(conn, _pragma(conn, 'freelist_count'))
+
+        wal_size = _wal_size()
+        if quiet and wal_size:
+            # Ночью можно подождать читателей и обрезать -wal до нуля
+            checkpoint(conn, 'TRUNCATE')
+        elif wal_size > WAL_CHECKPOINT_MB * 1024 * 1024:
+            checkpoint(conn, 'PASSIVE')
+    except sqlite3.OperationalError as e:
+        # БД занята - попробуем в следующий раз
+        logger.warning(f"Обслуживание БД пропущено: {e}")
+    finally:
+        conn.close()
+
+def db_stats():
+    """Состояние файла БД"""
+    conn = _connect()
+    try:
+        page_size = _pragma(conn, 'page_size')
+        page_count = _pragma(conn, 'page_count')
+        freelist = _pragma(conn, 'freelist_count')
+        auto_vacuum = _pragma(conn, 'auto_vacuum')
+    finally:
+        conn.close()
+
+    return {
+        'page_size': page_size,
+        'page_count': page_count,
+        'freelist_count': freelist,
+        'db_size': page_size * page_count,
+        'wal_size': _wal_size(),
+        'auto_vacuum': AUTO_VACUUM_MODES.get(auto_vacuum, str(auto_vacuum)),
+        'last_runs': dict(_last_runs),
+    }
+
+def format_stats(stats):
+    """Текст для /dbstats"""
+    mb = 1024 * 1024
+    lines = [
+        f"Файл БД: {stats['db_size'] / mb:.1f}МБ ({stats['page_count']} стр. по {stats['page_size']}Б)",
+        f"Свободных страниц: {stats['freelist_count']} ({stats['freelist_count'] * stats['page_size'] / mb:.1f}МБ)",
+        f"WAL: {stats['wal_size'] / mb:.1f}МБ (порог {WAL_CHECKPOINT_MB:.0f}МБ)",
+        f"auto_vacuum: {stats['auto_vacuum']}",
+    ]
+    if stats['auto_vacuum'] != 'INCREMENTAL':
+        # БД создана до включения auto_vacuum - incremental_vacuum ничего не делает
+        lines.append(
+            "⚠️ Вакуум в тихие часы не работает: БД без auto_vacuum. "
+            "Включить один раз: /dbstats vacuum (бэкап, затем VACUUM - запись ждёт до конца)"
+        )
+    names = {'analyze': 'ANALYZE', 'optimize': 'optimize', 'checkpoint': 'checkpoint', 'vacuum': 'vacuum'}
+    for key, title in names.items():
+        when = stats['last_runs'].get(key)
+        lines.append(f"{title}: {when:%Y-%m-%d %H:%M}" if when else f"{title}: ещё не было")
+    return "\n".join(lines)
+
+async def maintenance_loop():
+    """Периодическое обслуживание в фоне"""
+    loop = asyncio.get_running_loop()
+
+    while True:
+        try:
+            await loop.run_in_executor(None, run_maintenance)
+        except (sqlite3.Error, OSError) as e:
+            logger.error(f"Ошибка обслуживания БД: {e}")
+        await asyncio.sleep(MAINTENANCE_INTERVAL_MINUTES * 60)
+
+async def migrate_times():
+    """Перенести текстовые даты старых строк в числа, пачками в фоне"""
+    loop = asyncio.get_running_loop()
+    if await loop.run_in_executor(None, database.times_migrated):
+        return
+
+    started = time.monotonic()
+    try:
+        for table in ('users', 'groups'):
+            after_id = -2 ** 63
+            while True:
+                after_id = await loop.run_in_executor(
+                    None, database.migrate_times_step, table, after_id, MIGRATION_BATCH
+                )
+                if after_id is None:
+                    break
+                await asyncio.sleep(MIGRATION_PAUSE)
+        await loop.run_in_executor(None, database.mark_times_migrated)
+    except sqlite3.Error as e:
+        # Продолжим при следующем запуске - перенесённые строки пропускаются
+        logger.error(f"Перенос дат прерван: {e}")
+        return
+
+    logger.info(f"Даты перенесены в числа за {time.monotonic() - started:.1f}с")
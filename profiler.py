@@ -0,0 +1,332 @@
+import asyncio
+import contextvars
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from telegram import Update
+from telegram.ext import TypeHandler
+from telegram.request import BaseRequest
+
+logger = logging.getLogger(__name__)
+
+# Настройки профилирования
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_SLOW_MS = float(os.getenv('PROFILE_SLOW_MS', '300'))  # Порог медленного апдейта
+
+# Группы обработчиков, окружающие все остальные
+_START_GROUP = -1000
+_END_GROUP = 1000
+
+MAX_REPORT_LENGTH = 3500  # Лимит Telegram 4096 символов
+
+_session = None
+_current_update = contextvars.ContextVar('profiled_update', default=None)
+
+class _UpdateTiming:
+    """Время одного апдейта: всего, в БД и в Telegram API"""
+    __slots__ = ('started', 'db', 'api', 'profiled', 'finished')
+
+    def __init__(self, profiled):
+        self.started = time.perf_counter()
+        self.db = 0.0
+        self.api = 0.0
+        self.profiled = profiled
+        self.finished = False
+
+class _Session:
+    """Сессия профилирования"""
+
+    def __init__(self, application, mode, max_updates, seconds, sample_every, chat_id):
+        self.application = application
+        self.mode = mode
+        self.max_updates = max_updates
+        self.deadline = time.monotonic() + seconds if seconds else None
+        self.sample_every = sample_every
+        self.chat_id = chat_id
+
+        self.started_at = datetime.now()
+        self.updates = 0
+        self.total_time = 0.0
+        self.db_time = 0.0
+        self.api_time = 0.0
+        self.db_calls = defaultdict(lambda: [0, 0.0])  # функция -> [вызовы, секунды]
+        self.api_calls = defaultdict(lambda: [0, 0.0])  # метод -> [вызовы, секунды]
+        self.slow_updates = []
+
+        self.profile = cProfile.Profile() if mode == 'cpu' else None
+        self.profiling = 0
+        self.handlers = []
+        self.patched = {}
+        self.namespace = None
+        self.original_post = None
+        self.timer = None
+        self.finished = False
+
+    @property
+    def expired(self):
+        if self.max_updates and self.updates >= self.max_updates:
+            return True
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+def _describe(update):
+    """Короткое описание апдейта для лога"""
+    if update.callback_query:
+        return f"кнопка {update.callback_query.data} (чат {update.effective_chat.id if update.effective_chat else '?'})"
+    if update.effective_message and update.effective_message.text:
+        return f"{update.effective_message.text.split()[0]} (чат {update.effective_chat.id})"
+    return f"апдейт {update.update_id}"
+
+# ===== ХУКИ =====
+
+async def _on_update_start(update, context):
+    """Начало обработки апдейта"""
+    session = _session
+    if session is None or session.finished:
+        return
+
+    profiled = session.profile is not None and session.updates % session.sample_every == 0
+    timing = _UpdateTiming(profiled)
+    _current_update.set(timing)
+
+    if profiled:
+        if session.profiling == 0:
+            session.profile.enable()
+        session.profiling += 1
+
+async def _on_update_end(update, context):
+    """Конец обработки апдейта"""
+    session = _session
+    timing = _current_update.get()
+    if timing is None:
+        return
+    _current_update.set(None)
+    timing.finished = True
+
+    if timing.profiled and session is not None:
+        session.profiling -= 1
+        if session.profiling == 0:
+            session.profile.disable()
+
+    if session is None or session.finished:
+        return
+
+    total = time.perf_counter() - timing.started
+    session.updates += 1
+    session.total_time += total
+    session.db_time += timing.db
+    session.api_time += timing.api
+
+    if total * 1000 >= PROFILE_SLOW_MS:
+        session.slow_updates.append((datetime.now(), total, timing.db, timing.api, _describe(update)))
+
+    if session.expired:
+        # Отключать хуки уже после того, как этот апдейт обработан
+        asyncio.create_task(stop_session())
+
+def _wrap_db(name, func):
+    """Обёртка функции БД, считающая время"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        timing = _current_update.get()
+        if timing is None:
+            return func(*args, **kwargs)
+
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            timing.db += elapsed
+            if _session is not None:
+                # Подписчики шины событий дописывают рюмку уже после ответа -
+                # их время идёт в общий итог сессии
+                if timing.finished:
+                    _session.db_time += elapsed
+                stats = _session.db_calls[name]
+                stats[0] += 1
+                stats[1] += elapsed
+
+    return wrapper
+
+def _wrap_post(original_post):
+    """Обёртка запросов к Telegram API, считающая время"""
+    @functools.wraps(original_post)
+    async def post(self, url, *args, **kwargs):
+        timing = _current_update.get()
+        if timing is None:
+            return await original_post(self, url, *args, **kwargs)
+
+        started = time.perf_counter()
+        try:
+            return await original_post(self, url, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            timing.api += elapsed
+            if _session is not None:
+                stats = _session.api_calls[url.rsplit('/', 1)[-1]]
+                stats[0] += 1
+                stats[1] += elapsed
+
+    return post
+
+def _attach(session, namespace):
+    """Поставить хуки: обработчики вокруг всех групп и обёртки БД и API"""
+    application = session.application
+
+    start_handler = TypeHandler(Update, _on_update_start)
+    end_handler = TypeHandler(Update, _on_update_end)
+    application.add_handler(start_handler, group=_START_GROUP)
+    application.add_handler(end_handler, group=_END_GROUP)
+    session.handlers = [(start_handler, _START_GROUP), (end_handler, _END_GROUP)]
+
+    # Обработчики зовут функции БД по именам из своего модуля
+    for name, value in list(namespace.items()):
+        if callable(value) and getattr(value, '__module__', None) == 'database':
+            session.patched[name] = value
+            namespace[name] = _wrap_db(name, value)
+    session.namespace = namespace
+
+    session.original_post = BaseRequest.post
+    BaseRequest.post = _wrap_post(BaseRequest.post)
+
+def _detach(session):
+    """Снять хуки - без сессии профилировщик ничего не стоит"""
+    application = session.application
+
+    # Новый словарь вместо remove_handler: его может прямо сейчас обходить process_update
+    hooks = {id(handler) for handler, _ in session.handlers}
+    handlers = {}
+    for group, group_handlers in application.handlers.items():
+        kept = [handler for handler in group_handlers if id(handler) not in hooks]
+        if kept:
+            handlers[group] = kept
+    application.handlers = handlers
+
+    session.namespace.update(session.patched)
+    BaseRequest.post = session.original_post
+
+    if session.profiling:
+        session.profile.disable()
+        session.profiling = 0
+
+# ===== ОТЧЁТ =====
+
+def _format_calls(title, calls):
+    """Таблица вызовов по убыванию времени"""
+    lines = [title]
+    for name, (count, seconds) in sorted(calls.items(), key=lambda item: -item[1][1]):
+        lines.append(f"  {name}: {count} выз., {seconds * 1000:.1f}мс, {seconds / count * 1000:.2f}мс/выз.")
+    return lines
+
+def _write_report(session):
+    """Сохранить статистику в файлы, вернуть текст отчёта"""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stamp = session.started_at.strftime('%Y%m%d-%H%M%S')
+    base = os.path.join(PROFILE_DIR, f'profile-{stamp}')
+
+    updates = max(session.updates, 1)
+    lines = [
+        f"Профилирование ({session.mode}) с {session.started_at:%H:%M:%S}",
+        f"Апдейтов: {session.updates}",
+        f"В среднем: всего {session.total_time / updates * 1000:.1f}мс, "
+        f"БД {session.db_time / updates * 1000:.1f}мс, "
+        f"Telegram API {session.api_time / updates * 1000:.1f}мс",
+        f"Медленных (>{PROFILE_SLOW_MS:.0f}мс): {len(session.slow_updates)}",
+        "",
+    ]
+    lines += _format_calls("БД:", session.db_calls)
+    lines += _format_calls("Telegram API:", session.api_calls)
+
+    if session.profile is not None:
+        session.profile.dump_stats(base + '.prof')
+        stream = io.StringIO()
+        stats = pstats.Stats(session.profile, stream=stream)
+        stats.sort_stats('cumulative').print_stats(30)
+        with open(base + '.txt', 'w', encoding='utf-8') as f:
+            f.write(stream.getvalue())
+
+    with open(base + '-slow.log', 'w', encoding='utf-8') as f:
+        for when, total, db, api, what in session.slow_updates:
+            f.write(
+                f"{when:%Y-%m-%d %H:%M:%S} всего={total * 1000:.1f}мс "
+                f"бд={db * 1000:.1f}мс api={api * 1000:.1f}мс "
+                f"прочее={(total - db - api) * 1000:.1f}мс {what}\n"
+            )
+
+    lines += ["", f"Файлы: {base}*"]
+    return "\n".join(lines)
+
+# ===== УПРАВЛЕНИЕ =====
+
+def is_active():
+    """Идёт ли профилирование"""
+    return _session is not None
+
+def start_session(application, namespace, mode, max_updates=0, seconds=0, sample_every=1, chat_id=None):
+    """Включить профилирование на max_updates апдейтов или seconds секунд"""
+    global _session
+
+    if _session is not None:
+        raise RuntimeError("Профилирование уже идёт")
+    if mode not in ('cpu', 'wall'):
+        raise ValueError("Режим должен быть cpu или wall")
+    # Без положительного лимита сессия не закончилась бы никогда
+    if max_updates < 0 or seconds < 0 or (max_updates == 0 and seconds == 0):
+        raise ValueError("Лимит должен быть больше нуля: апдейтов или секунд")
+    if sample_every <= 0:
+        raise ValueError("Шаг выборки должен быть больше нуля")
+
+    session = _Session(application, mode, max_updates, seconds, sample_every, chat_id)
+    _attach(session, namespace)
+    _session = session
+
+    if seconds:
+        async def stop_later():
+            await asyncio.sleep(seconds)
+            await stop_session()
+
+        session.timer = asyncio.create_task(stop_later())
+
+    logger.info(f"Профилирование {mode} включено")
+
+async def stop_session():
+    """Выключить профилирование и отправить отчёт админу"""
+    global _session
+
+    session = _session
+    if session is None or session.finished:
+        return None
+
+    session.finished = True
+    _session = None
+    _detach(session)
+    if session.timer and session.timer is not asyncio.current_task():
+        session.timer.cancel()
+
+    report = _write_report(session)
+    logger.info(report)
+
+    if session.chat_id is not None:
+        await session.application.bot.send_message(session.chat_id, report[:MAX_REPORT_LENGTH])
+
+    return report
+
+def status():
+    """Текущее состояние для /prof"""
+    session = _session
+    if session is None:
+        return "Профилирование выключено"
+
+    limits = []
+    if session.max_updates:
+        limits.append(f"{session.updates}/{session.max_updates} апдейтов")
+    if session.deadline is not None:
+        limits.append(f"осталось {max(0, session.deadline - time.monotonic()):.0f}с")
+    return f"Профилирование {session.mode}: " + ", ".join(limits)
@@ -0,0 +1,145 @@
+import logging
+import os
+import pickle
+import sqlite3
+import struct
+import zlib
+
+import database
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'VMCACHE1'
+
+# Версия формата снимка: поднимать при любом изменении строк users/groups,
+# которые лежат в кэшах (новая колонка, другой порядок)
+# 2 - users.achievements_mask
+# 3 - users.last_drink_ts, last_drink_day, join_ts и groups.join_ts
+SNAPSHOT_VERSION = 3
+
+# Таблицы, строки которых попадают в снимок целиком
+_CACHED_TABLES = ('users', 'groups')
+
+def snapshot_path():
+    """Снимок лежит рядом с файлом БД"""
+    return database.DB_PATH + '.cache'
+
+def db_fingerprint():
+    """Версия данных БД: меняется при любой записи в файл после снимка"""
+    try:
+        stat = os.stat(database.DB_PATH)
+        with open(database.DB_PATH, 'rb') as f:
+            header = f.read(100)
+    except OSError:
+        return None
+    if len(header) < 100:
+        return None
+
+    # Непустой -wal значит, что в БД писали после снимка
+    try:
+        wal_size = os.path.getsize(database.DB_PATH + '-wal')
+    except OSError:
+        wal_size = 0
+
+    # Счётчик изменений файла и версия схемы из заголовка SQLite
+    change_counter, = struct.unpack('>I', header[24:28])
+    schema_cookie, = struct.unpack('>I', header[40:44])
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns, wal_size, change_counter, schema_cookie)
+
+def schema_signature():
+    """Форма строк в кэшах: user_version, колонки таблиц и счётчик схемы"""
+    conn = sqlite3.connect(database.DB_PATH)
+    try:
+        user_version, = conn.execute('PRAGMA user_version').fetchone()
+        schema_cookie, = conn.execute('PRAGMA schema_version').fetchone()
+        columns = tuple(
+            (table, tuple(row[1] for row in conn.execute(f'PRAGMA table_info({table})')))
+            for table in _CACHED_TABLES
+        )
+    finally:
+        conn.close()
+    return user_version, columns, schema_cookie
+
+def _flush_wal():
+    """Перенести WAL в основной файл, чтобы отпечаток описывал все данные"""
+    conn = sqlite3.connect(database.DB_PATH)
+    try:
+        busy, _, _ = conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+    finally:
+        conn.close()
+    return not busy
+
+def save_snapshot():
+    """Сохранить горячее состояние при штатной остановке"""
+    if not _flush_wal():
+        logger.warning("Снимок кэша не сохранён: БД занята")
+        return False
+
+    state = database.export_hot_state()
+    payload = zlib.compress(pickle.dumps(
+        (db_fingerprint(), schema_signature(), state), pickle.HIGHEST_PROTOCOL
+    ))
+
+    path = snapshot_path()
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('>I', SNAPSHOT_VERSION))
+        f.write(payload)
+    os.replace(tmp_path, path)
+
+    logger.info(f"Снимок кэша сохранён: {path}, {len(payload)} байт")
+    return True
+
+def discard_snapshot():
+    """Удалить снимок: кэши этого процесса не отражают БД"""
+    try:
+        os.remove(snapshot_path())
+    except FileNotFoundError:
+        return
+    logger.info("Снимок кэша удалён")
+
+def read_snapshot():
+    """Прочитать снимок, если файл БД с тех пор не менялся. Вызывать до init_db():
+    даже миграция без изменений пишет в файл и меняет отпечаток"""
+    path = snapshot_path()
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+
+    header = len(MAGIC) + 4
+    if len(data) < header or not data.startswith(MAGIC):
+        logger.warning("Снимок кэша повреждён, пропускаю")
+        return None
+
+    version, = struct.unpack('>I', data[len(MAGIC):header])
+    if version != SNAPSHOT_VERSION:
+        logger.info(f"Снимок кэша другого формата ({version}, нужен {SNAPSHOT_VERSION}), пропускаю")
+        return None
+
+    try:
+        fingerprint, schema, state = pickle.loads(zlib.decompress(data[header:]))
+    except (zlib.error, pickle.UnpicklingError, EOFError, ValueError) as e:
+        logger.warning(f"Снимок кэша не читается: {e}")
+        return None
+
+    if fingerprint is None or fingerprint != db_fingerprint():
+        logger.info("Снимок кэша устарел: БД менялась после него")
+        return None
+    return schema, state
+
+def load_snapshot(snapshot):
+    """Восстановить кэши из read_snapshot() после init_db(), если схема не менялась"""
+    if snapshot is None:
+        return False
+
+    schema, state = snapshot
+    if schema != schema_signature():
+        logger.info("Снимок кэша устарел: схема БД изменилась")
+        return False
+
+    database.import_hot_state(state)
+    logger.info("Кэши восстановлены из снимка")
+    return True
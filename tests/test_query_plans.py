@@ -0,0 +1,247 @@
+"""Планы запросов database.py на БД реалистичного размера
+
+Каждая функция database.py вызывается на заполненной базе, все её SQL-запросы
+перехватываются и проверяются через EXPLAIN QUERY PLAN: запрос должен идти по
+задуманному индексу, без полного скана и без сортировки во временном B-дереве.
+Заодно проверяется время ответа, чтобы поиск не превратился в скан незаметно.
+
+Запуск: python -m pytest -q tests  (или python -m unittest discover tests)
+
+Размер базы и бюджеты времени настраиваются через QUERY_TEST_USERS и
+QUERY_BUDGET_SCALE (множитель для медленных машин).
+"""
+import inspect
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+
+USERS = int(os.getenv('QUERY_TEST_USERS', '100000'))
+GROUPS = max(1, USERS // 50)
+MEMBERS_PER_GROUP = 40
+BUDGET_SCALE = float(os.getenv('QUERY_BUDGET_SCALE', '1'))
+REPEAT = 20
+
+# Бюджеты по медиане, мс. С запасом: ловят скан, а не шум
+POINT_BUDGET_MS = 5
+TOP_BUDGET_MS = 10
+BATCH_BUDGET_MS = 50
+
+PK = 'INTEGER PRIMARY KEY'
+
+# Служебные команды - плана запроса у них нет
+NOT_QUERIES = ('PRAGMA', 'BEGIN', 'COMMIT', 'ROLLBACK', 'CREATE', 'ALTER')
+
+def seed(path):
+    """Заполнить БД, похожую на боевую"""
+    rnd = random.Random(42)
+    today = datetime.now()
+    conn = sqlite3.connect(path)
+
+    def users():
+        for user_id in range(1, USERS + 1):
+            days_ago = rnd.randint(0, 30)
+            last = today - timedelta(days=days_ago, hours=rnd.randint(0, 23))
+            total = rnd.randint(0, 600)
+            yield (user_id, f'user{user_id}', total, rnd.randint(1, 8),
+                   last.date().toordinal(), int(last.timestamp()), database.calculate_level(total),
+                   rnd.random() * 1000, int(last.timestamp()), 0)
+
+    conn.executemany('''
+        INSERT INTO users (user_id, username, total_drinks, today_drinks, last_drink_day,
+                           join_ts, level, vodka_liters, last_drink_ts, achievements_mask)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', users())
+
+    conn.executemany(
+        'INSERT INTO groups (group_id, group_name, total_drinks, join_ts) VALUES (?, ?, ?, ?)',
+        ((-group_id, f'group{group_id}', rnd.randint(0, 10000), int(today.timestamp()))
+         for group_id in range(1, GROUPS + 1)))
+
+    def members():
+        for group_id in range(1, GROUPS + 1):
+            for user_id in rnd.sample(range(1, USERS + 1), min(MEMBERS_PER_GROUP, USERS)):
+                yield (-group_id, user_id, rnd.randint(0, 200))
+
+    conn.executemany(
+        'INSERT OR IGNORE INTO group_members (group_id, user_id, drinks_in_group) VALUES (?, ?, ?)',
+        members())
+    conn.commit()
+
+    # Статистика для планировщика, как после maintenance.analyze_if_needed
+    conn.execute('ANALYZE')
+    conn.commit()
+    conn.close()
+
+def _clear_caches():
+    database._user_cache.clear()
+    database._group_cache.clear()
+    database._known_groups.clear()
+    database._known_members.clear()
+
+class QueryPlanTest(unittest.TestCase):
+    """EXPLAIN QUERY PLAN и время для каждой функции database.py"""
+
+    # Функция -> (аргументы, {таблица: индекс}, таблицы, которые можно читать целиком, бюджет мс).
+    # Запросы к таблице, которой нет в словаре, считаются ошибкой - новый запрос надо описать здесь
+    CALLS = {
+        'get_or_create_user': ((7, 'user7'), {'users': PK}, (), POINT_BUDGET_MS),
+        'get_user_data': ((7,), {'users': PK}, (), POINT_BUDGET_MS),
+        'can_drink': ((7,), {'users': PK}, (), POINT_BUDGET_MS),
+        'add_drink': ((7,), {'users': PK}, (), POINT_BUDGET_MS),
+        'get_leaderboard': ((10,), {'users': 'idx_users_total_drinks'}, (), TOP_BUDGET_MS),
+        'get_today_leaderboard': ((10,), {'users': 'idx_users_day'}, (), TOP_BUDGET_MS),
+        'update_level': ((7,), {'users': PK}, (), POINT_BUDGET_MS),
+        'add_vodka': ((7, 1), {'users': PK}, (), POINT_BUDGET_MS),
+        'remove_vodka': ((7, 1), {'users': PK}, (), POINT_BUDGET_MS),
+        'add_levels': ((7, 0), {'users': PK}, (), POINT_BUDGET_MS),
+        'get_user_by_username': (('@user7',), {'users': ('idx_users_username', 'sqlite_autoindex_users_1')},
+                                 (), POINT_BUDGET_MS),
+        '_rename_group': ((-3, 'group3'), {'groups': PK}, (), POINT_BUDGET_MS),
+        'add_group': ((-3, 'renamed'), {'groups': PK}, (), POINT_BUDGET_MS),
+        'add_user_to_group': ((-3, 7), {}, (), POINT_BUDGET_MS),
+        'add_group_drink': ((-3, 7, 0), {'groups': PK, 'group_members': 'sqlite_autoindex_group_members_1',
+                                         'users': PK},
+                            (), POINT_BUDGET_MS),
+        'get_group_top': ((-3, 10), {'gm': 'idx_group_members_drinks', 'u': PK}, (), POINT_BUDGET_MS),
+        'get_group_info': ((-3,), {'groups': PK}, (), POINT_BUDGET_MS),
+        'set_live_message': ((-3, None), {'groups': PK}, (), POINT_BUDGET_MS),
+        'get_live_messages': ((), {'groups': 'idx_groups_live'}, (), POINT_BUDGET_MS),
+        'migrate_times_step': (('users', 0, 1000), {'users': PK}, (), BATCH_BUDGET_MS),
+        # Загружает реестр целиком при старте - полный проход здесь и задуман
+        'load_registry': ((), {}, ('groups', 'group_members'), None),
+    }
+
+    # Функции без своих запросов к данным
+    NOT_QUERY_FUNCTIONS = {'init_db', '_add_column_if_missing', 'times_migrated', 'mark_times_migrated'}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.workdir = tempfile.mkdtemp(prefix='vodka-plans-')
+        cls.old_path = database.DB_PATH
+        database.DB_PATH = os.path.join(cls.workdir, 'plans.db')
+        database.init_db()
+        seed(database.DB_PATH)
+
+    @classmethod
+    def tearDownClass(cls):
+        database.DB_PATH = cls.old_path
+        _clear_caches()
+        shutil.rmtree(cls.workdir, ignore_errors=True)
+
+    def setUp(self):
+        _clear_caches()
+
+    def _trace(self, name):
+        """Выполнить функцию и вернуть все её SQL-запросы с подставленными параметрами"""
+        args = self.CALLS[name][0]
+        statements = []
+        connect = sqlite3.connect
+
+        def traced_connect(*a, **kw):
+            conn = connect(*a, **kw)
+            conn.set_trace_callback(statements.append)
+            return conn
+
+        with mock.patch.object(database.sqlite3, 'connect', traced_connect):
+            getattr(database, name)(*args)
+        return [sql for sql in statements if not sql.lstrip().upper().startswith(NOT_QUERIES)]
+
+    def _plan(self, sql):
+        conn = sqlite3.connect(database.DB_PATH)
+        try:
+            return [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql)]
+        finally:
+            conn.close()
+
+    def _check_plan(self, name):
+        _, indexes, full_scans, _ = self.CALLS[name]
+        statements = self._trace(name)
+        self.assertTrue(statements, f"{name}: не выполнил ни одного запроса")
+
+        for sql in statements:
+            for step in self._plan(sql):
+                context = f"{name}: {' '.join(sql.split())}\n  план: {step}"
+                self.assertNotIn('TEMP B-TREE', step, context)
+
+                words = step.split()
+                if words[0] not in ('SCAN', 'SEARCH'):
+                    continue
+                table = words[1]
+
+                if table in full_scans:
+                    continue
+                self.assertIn(table, indexes, f"неописанный запрос к таблице - {context}")
+
+                expected = indexes[table]
+                expected = expected if isinstance(expected, tuple) else (expected,)
+                if words[0] == 'SCAN':
+                    # Скан допустим только по индексу в нужном порядке (топ с LIMIT)
+                    self.assertIn('USING', words, f"полный скан - {context}")
+                self.assertTrue(any(index in step for index in expected),
+                                f"ожидался индекс {' или '.join(expected)} - {context}")
+
+    def _check_latency(self, name):
+        args, _, _, budget = self.CALLS[name]
+        if budget is None:
+            return
+        function = getattr(database, name)
+
+        timings = []
+        for _ in range(REPEAT):
+            # Кэши обходим, чтобы мерить саму БД
+            _clear_caches()
+            started = time.perf_counter()
+            function(*args)
+            timings.append((time.perf_counter() - started) * 1000)
+
+        median = statistics.median(timings)
+        self.assertLess(median, budget * BUDGET_SCALE,
+                        f"{name}: медиана {median:.2f}мс при бюджете {budget * BUDGET_SCALE:.1f}мс")
+
+    def test_every_query_function_is_checked(self):
+        """Новая функция с SQL должна попасть в CALLS"""
+        with_sql = {
+            name for name, function in inspect.getmembers(database, inspect.isfunction)
+            if function.__module__ == database.__name__ and '.execute(' in inspect.getsource(function)
+        }
+        missing = with_sql - set(self.CALLS) - self.NOT_QUERY_FUNCTIONS
+        self.assertFalse(missing, f"нет проверки плана для: {', '.join(sorted(missing))}")
+
+    def test_today_leaderboard_skips_stale_days(self):
+        """В топе за сегодня только те, кто пил сегодня"""
+        conn = sqlite3.connect(database.DB_PATH)
+        try:
+            drank_today = {row[0] for row in conn.execute(
+                'SELECT user_id FROM users WHERE last_drink_day = ?', (database.today_number(),))}
+        finally:
+            conn.close()
+
+        top = database.get_today_leaderboard(10)
+        self.assertTrue(top)
+        self.assertTrue(all(user_id in drank_today for user_id, _, _ in top))
+        self.assertEqual([row[2] for row in top], sorted((row[2] for row in top), reverse=True))
+
+def _make_test(name):
+    def test(self):
+        self._check_plan(name)
+        self._check_latency(name)
+    test.__doc__ = f"План и время {name}"
+    return test
+
+for _name in QueryPlanTest.CALLS:
+    setattr(QueryPlanTest, f'test_{_name.lstrip("_")}', _make_test(_name))
+
+if __name__ == '__main__':
+    unittest.main()
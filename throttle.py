@@ -0,0 +1,181 @@
+import functools
+import os
+import time
+from collections import Counter, OrderedDict
+
+def _parse_limit(value):
+    """Лимит вида "5/10": 5 запросов за 10 секунд -> (ёмкость, токенов в секунду)"""
+    count, seconds = value.split('/')
+    capacity = float(count)
+    return capacity, capacity / float(seconds)
+
+# Лимиты: запросов / секунд
+USER_LIMIT = _parse_limit(os.getenv('THROTTLE_USER', '5/10'))
+CHAT_LIMIT = _parse_limit(os.getenv('THROTTLE_CHAT', '20/10'))
+COMMAND_LIMITS = {
+    'grouptop': _parse_limit(os.getenv('THROTTLE_GROUPTOP', '3/30')),
+    'groupstats': _parse_limit(os.getenv('THROTTLE_GROUPSTATS', '3/30')),
+    'profile': _parse_limit(os.getenv('THROTTLE_PROFILE', '5/30')),
+}
+
+REPLY_CACHE_TTL = float(os.getenv('THROTTLE_CACHE_TTL', '60'))  # Сколько живёт ответ из кэша
+MAX_BUCKETS = 100000  # После этого выкидываем полные (простаивающие) корзины
+MAX_REPLIES = 10000  # Ответов в кэше, самые старые вытесняются
+
+# Команды, ответ на которые зависит от пользователя, а не только от чата
+PER_USER_REPLIES = {'profile'}
+
+class TokenBucket:
+    """Корзина токенов: capacity запросов подряд, дальше rate в секунду"""
+    __slots__ = ('capacity', 'rate', 'tokens', 'updated')
+
+    def __init__(self, capacity, rate, now=None):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def peek(self, now=None, tokens=1):
+        """Хватает ли токенов, не тратя их"""
+        self._refill(time.monotonic() if now is None else now)
+        return self.tokens >= tokens
+
+    def consume(self, now=None, tokens=1):
+        """Потратить токены, если хватает"""
+        if not self.peek(now, tokens):
+            return False
+        self.tokens -= tokens
+        return True
+
+    def wait_time(self, now=None, tokens=1):
+        """Сколько секунд ждать, пока хватит токенов"""
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens >= tokens:
+            return 0.0
+        return (tokens - self.tokens) / self.rate
+
+    @property
+    def full(self):
+        return self.tokens >= self.capacity
+
+class Throttler:
+    """Лимиты на пользователя, чат и команду в чате"""
+
+    def __init__(self, user_limit=USER_LIMIT, chat_limit=CHAT_LIMIT, command_limits=None):
+        self.user_limit = user_limit
+        self.chat_limit = chat_limit
+        self.command_limits = COMMAND_LIMITS if command_limits is None else command_limits
+
+        self._buckets = {}
+        self._replies = OrderedDict()  # ключ -> [текст, параметры, время, уже отдан], от старых к новым
+
+        self.allowed = Counter()
+        self.cached = Counter()
+        self.dropped = Counter()
+
+    def _bucket(self, key, limit, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= MAX_BUCKETS:
+                self._prune(now)
+            bucket = self._buckets[key] = TokenBucket(limit[0], limit[1], now)
+        return bucket
+
+    def _prune(self, now):
+        """Выкинуть полные корзины - они ничем не отличаются от новых"""
+        for key, bucket in list(self._buckets.items()):
+            if bucket.peek(now, bucket.capacity):
+                del self._buckets[key]
+
+    def allow(self, user_id, chat_id, command):
+        """Пропустить запрос? Токены тратятся, только если хватает во всех корзинах"""
+        now = time.monotonic()
+        buckets = [
+            self._bucket(('user', user_id), self.user_limit, now),
+            self._bucket(('chat', chat_id), self.chat_limit, now),
+        ]
+        if command in self.command_limits:
+            buckets.append(self._bucket(('command', chat_id, command), self.command_limits[command], now))
+
+        if not all(bucket.peek(now) for bucket in buckets):
+            return False
+
+        for bucket in buckets:
+            bucket.consume(now)
+        return True
+
+    def remember(self, key, text, kwargs):
+        """Запомнить ответ для выдачи из кэша"""
+        now = time.monotonic()
+        self._replies[key] = [text, kwargs, now, False]
+        self._replies.move_to_end(key)
+
+        # Старые ответы в начале: выкинуть протухшие и лишние сверх MAX_REPLIES
+        while self._replies:
+            oldest = next(iter(self._replies.values()))
+            if now - oldest[2] <= REPLY_CACHE_TTL and len(self._replies) <= MAX_REPLIES:
+                break
+            self._replies.popitem(last=False)
+
+    def take_cached(self, key):
+        """Свежий ответ из кэша; каждый отдаётся один раз, чтобы не спамить в чат"""
+        entry = self._replies.get(key)
+        if entry is None or entry[3]:
+            return None
+        if time.monotonic() - entry[2] > REPLY_CACHE_TTL:
+            del self._replies[key]
+            return None
+        entry[3] = True
+        return entry[0], entry[1]
+
+    def stats(self):
+        """Счётчики для админа"""
+        lines = [f"Корзин: {len(self._buckets)}, ответов в кэше: {len(self._replies)}"]
+        for command in sorted(set(self.allowed) | set(self.cached) | set(self.dropped)):
+            lines.append(
+                f"/{command}: пропущено {self.allowed[command]}, "
+                f"из кэша {self.cached[command]}, отброшено {self.dropped[command]}"
+            )
+        return "\n".join(lines)
+
+throttler = Throttler()
+
+def cache_key(update, command):
+    """Ключ ответа в кэше"""
+    if command in PER_USER_REPLIES:
+        return (update.effective_chat.id, update.effective_user.id, command)
+    return (update.effective_chat.id, command)
+
+async def reply_cached(update, command, text, **kwargs):
+    """Ответить и запомнить ответ на случай превышения лимита"""
+    throttler.remember(cache_key(update, command), text, kwargs)
+    await update.message.reply_text(text, **kwargs)
+
+def throttled(command):
+    """Декоратор обработчика: лишние запросы отвечаются из кэша или отбрасываются до работы с БД"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            user = update.effective_user
+            chat = update.effective_chat
+
+            if throttler.allow(user.id if user else 0, chat.id, command):
+                throttler.allowed[command] += 1
+                return await handler(update, context)
+
+            cached = throttler.take_cached(cache_key(update, command))
+            if cached is None:
+                throttler.dropped[command] += 1
+                return
+
+            throttler.cached[command] += 1
+            text, kwargs = cached
+            await update.message.reply_text(text, **kwargs)
+
+        return wrapper
+    return decorator
@@ -0,0 +1,350 @@
+"""Пул процессов-воркеров для обработки апдейтов
+
+Фронтенд получает апдейты как обычно и раздаёт их воркерам по id чата: один
+чат всегда попадает в один процесс, поэтому порядок внутри чата сохраняется,
+а состояние чата (реестр группы, живой топ, лимиты) живёт в своём процессе.
+Лимиты на чат и команду поэтому точные, а корзина пользователя своя в каждом
+воркере: пишущий в чаты разных воркеров получает до N лимитов THROTTLE_USER.
+Воркер запускает то же приложение из main.py, но без своей сети: каждый
+вызов Bot API уходит по пайпу во фронтенд и выполняется его HTTP-клиентом.
+
+Фоновые задачи (бэкапы, обслуживание БД, рассылки) работают только во
+фронтенде, команды для них туда и не уходят. /prof, /throttle и /events тоже
+остаются во фронтенде и отказывают: у каждого воркера свои счётчики, а сводить
+их фронтенд не умеет.
+
+Подтверждений нет: апдейты, уже записанные в пайп упавшего воркера, теряются.
+"""
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+
+from telegram import Update
+from telegram.error import NetworkError, TelegramError
+from telegram.ext import ApplicationHandlerStop, TypeHandler
+from telegram.request import BaseRequest, RequestData
+
+import database
+
+logger = logging.getLogger(__name__)
+
+WORKER_PROCESSES = int(os.getenv('WORKER_PROCESSES', '0'))  # 0 - всё в одном процессе
+WORKER_START_TIMEOUT = 60  # Секунд на запуск воркера
+WORKER_STOP_TIMEOUT = 30  # Секунд на дообработку очереди воркера при остановке
+
+# Команды фоновых задач фронтенда и статистика, которую один воркер показал бы как общую
+FRONT_COMMANDS = {'backup', 'broadcast', 'dbstats', 'prof', 'throttle', 'events'}
+
+ROUTER_GROUP = -10000  # Раньше всех обработчиков, включая профилировщик
+
+_TIMEOUTS = ('read_timeout', 'write_timeout', 'connect_timeout', 'pool_timeout')
+
+def _command(update):
+    """Имя команды без / и @бота или None"""
+    message = update.message
+    if not message or not message.text or not message.text.startswith('/'):
+        return None
+    return message.text.split()[0][1:].split('@')[0].lower()
+
+def _chat_key(update):
+    """Ключ маршрутизации: чат, а без чата - пользователь"""
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return 0
+
+# ===== ВОРКЕР =====
+
+class _WorkerChannel:
+    """Пайп воркера: апдейты и ответы API от фронтенда, запросы API к нему"""
+
+    def __init__(self, conn, loop):
+        self._conn = conn
+        self._loop = loop
+        self._calls = {}
+        self._ids = itertools.count()
+        self._send_lock = threading.Lock()
+        self.stopped = asyncio.Event()
+
+    def send(self, message):
+        with self._send_lock:
+            self._conn.send(message)
+
+    async def call(self, **request):
+        """Выполнить запрос к Bot API через фронтенд"""
+        call_id = next(self._ids)
+        future = self._loop.create_future()
+        self._calls[call_id] = future
+        self.send(('api', call_id, request))
+        try:
+            return await future
+        finally:
+            self._calls.pop(call_id, None)
+
+    def _resolve(self, call_id, result, error):
+        future = self._calls.get(call_id)
+        if future is None or future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _put_update(self, application, data):
+        application.update_queue.put_nowait(Update.de_json(data, application.bot))
+
+    def _read(self, application):
+        """Поток чтения пайпа"""
+        call = self._loop.call_soon_threadsafe
+        while True:
+            try:
+                message = self._conn.recv()
+            except (EOFError, OSError):
+                # Фронтенд пропал - останавливаемся
+                call(self.stopped.set)
+                return
+
+            kind = message[0]
+            if kind == 'update':
+                call(self._put_update, application, message[1])
+            elif kind == 'result':
+                call(self._resolve, message[1], message[2], None)
+            elif kind == 'error':
+                call(self._resolve, message[1], None, message[2])
+            elif kind == 'stop':
+                call(self.stopped.set)
+                return
+
+    def start(self, application):
+        threading.Thread(target=self._read, args=(application,), daemon=True).start()
+
+class IPCRequest(BaseRequest):
+    """Запросы к Bot API из воркера выполняет фронтенд"""
+
+    def __init__(self, channel):
+        self._channel = channel
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        if request_data is not None and request_data.contains_files:
+            raise TelegramError("Отправка файлов из воркера не поддерживается")
+
+        # Значения по умолчанию подставит HTTP-клиент фронтенда
+        timeouts = {
+            name: value
+            for name, value in zip(_TIMEOUTS, (read_timeout, write_timeout, connect_timeout, pool_timeout))
+            if value is not BaseRequest.DEFAULT_NONE
+        }
+        parameters = request_data.json_parameters if request_data is not None else None
+        return await self._channel.call(url=url, method=method, parameters=parameters, **timeouts)
+
+async def _run_worker(conn, token, base_url):
+    import main
+
+    channel = _WorkerChannel(conn, asyncio.get_running_loop())
+    app = main.build_application(token, base_url=base_url, request=IPCRequest(channel))
+    channel.start(app)
+
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    channel.send(('ready',))
+
+    await channel.stopped.wait()
+
+    # stop() дообрабатывает уже полученные апдейты
+    await app.stop()
+    await app.post_shutdown(app)
+    await app.shutdown()
+    try:
+        channel.send(('stopped',))
+    except OSError:
+        pass
+
+def _worker_main(conn, token, base_url, db_path):
+    """Точка входа процесса-воркера"""
+    database.DB_PATH = db_path
+    database.USE_USER_CACHE = False
+    database.load_registry()
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    asyncio.run(_run_worker(conn, token, base_url))
+
+# ===== ФРОНТЕНД =====
+
+class _ForwardedRequestData(RequestData):
+    """Параметры запроса воркера, уже приведённые к JSON на его стороне"""
+
+    __slots__ = ('_json_parameters',)
+
+    def __init__(self, json_parameters):
+        super().__init__()
+        self._json_parameters = json_parameters
+
+    @property
+    def json_parameters(self):
+        return self._json_parameters
+
+    @property
+    def multipart_data(self):
+        # Файлы из воркера не отправляются
+        return None
+
+class _Worker:
+    """Процесс-воркер со стороны фронтенда"""
+
+    def __init__(self, index, pool):
+        self.index = index
+        self._pool = pool
+        self._conn = None
+        self._process = None
+        self._ready = None
+        self._stopped = None
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self._conn, child_conn = self._pool.context.Pipe()
+        self._process = self._pool.context.Process(
+            target=_worker_main,
+            args=(child_conn, self._pool.token, self._pool.base_url, database.DB_PATH),
+            name=f'vodka-worker-{self.index}',
+            daemon=True,
+        )
+        self._process.start()
+        child_conn.close()
+
+        self._ready = loop.create_future()
+        self._stopped = loop.create_future()
+        loop.add_reader(self._conn.fileno(), self._on_readable)
+
+    def send(self, message):
+        try:
+            self._conn.send(message)
+        except OSError:
+            logger.error(f"Воркер {self.index} недоступен, апдейт потерян")
+            self._restart()
+
+    def _on_readable(self):
+        try:
+            while self._conn.poll():
+                message = self._conn.recv()
+                if message[0] == 'api':
+                    asyncio.ensure_future(self._perform(message[1], message[2]))
+                elif message[0] == 'ready' and not self._ready.done():
+                    self._ready.set_result(True)
+                elif message[0] == 'stopped' and not self._stopped.done():
+                    self._stopped.set_result(True)
+        except (EOFError, OSError):
+            self._restart()
+
+    async def _perform(self, call_id, request):
+        """Выполнить запрос воркера настоящим HTTP-клиентом"""
+        parameters = request.pop('parameters')
+        if parameters is not None:
+            request['request_data'] = _ForwardedRequestData(parameters)
+        try:
+            result = await self._pool.request.do_request(**request)
+        except TelegramError as e:
+            reply = ('error', call_id, e)
+        except Exception as e:
+            reply = ('error', call_id, NetworkError(f"{type(e).__name__}: {e}"))
+        else:
+            reply = ('result', call_id, result)
+
+        try:
+            self._conn.send(reply)
+        except OSError:
+            pass
+
+    def _detach(self):
+        try:
+            asyncio.get_running_loop().remove_reader(self._conn.fileno())
+        except (OSError, ValueError):
+            pass
+        self._conn.close()
+
+    def _restart(self):
+        """Воркер упал - поднять новый на то же место"""
+        self._detach()
+        if self._stopped.done() or not self._pool.running:
+            if not self._stopped.done():
+                self._stopped.set_result(False)
+            return
+        self._process.join(1)
+        logger.error(f"Воркер {self.index} завершился (код {self._process.exitcode}), перезапускаю")
+        self._stopped.cancel()
+        self._ready.cancel()
+        self.start()
+
+    async def wait_ready(self):
+        """Дождаться, пока воркер поднимет приложение"""
+        await asyncio.wait_for(asyncio.shield(self._ready), WORKER_START_TIMEOUT)
+
+    async def stop(self):
+        """Дать воркеру дообработать очередь и завершиться"""
+        try:
+            self._conn.send(('stop',))
+            await asyncio.wait_for(asyncio.shield(self._stopped), WORKER_STOP_TIMEOUT)
+        except (OSError, asyncio.TimeoutError, asyncio.CancelledError):
+            logger.warning(f"Воркер {self.index} не остановился вовремя")
+
+        if not self._conn.closed:
+            self._detach()
+        await asyncio.get_running_loop().run_in_executor(None, self._process.join, 5)
+        if self._process.is_alive():
+            self._process.terminate()
+
+class WorkerPool:
+    """Раздаёт апдейты воркерам по id чата"""
+
+    def __init__(self, size, token, base_url=None):
+        self.size = size
+        self.token = token
+        self.base_url = base_url
+        # spawn: форк процесса с живым циклом событий и потоками небезопасен
+        self.context = multiprocessing.get_context('spawn')
+        self.request = None
+        self.running = False
+        self._workers = []
+
+    def attach(self, application):
+        """Перехватывать апдейты до всех обработчиков приложения"""
+        application.add_handler(TypeHandler(Update, self.route), group=ROUTER_GROUP)
+
+    async def start(self, application):
+        self.request = application.bot.request
+        self.running = True
+        self._workers = [_Worker(index, self) for index in range(self.size)]
+        for worker in self._workers:
+            worker.start()
+        # Апдейты до готовности воркеров копились бы в пайпах
+        await asyncio.gather(*(worker.wait_ready() for worker in self._workers))
+        logger.info(f"Запущено воркеров: {self.size}")
+
+    async def stop(self):
+        self.running = False
+        await asyncio.gather(*(worker.stop() for worker in self._workers))
+        self._workers = []
+
+    async def route(self, update, context):
+        """Отдать апдейт воркеру его чата"""
+        if _command(update) in FRONT_COMMANDS:
+            return
+        worker = self._workers[_chat_key(update) % self.size]
+        worker.send(('update', update.to_dict()))
+        raise ApplicationHandlerStop